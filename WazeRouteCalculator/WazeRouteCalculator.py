@@ -1,13 +1,39 @@
 # -*- coding: utf-8 -*-
 """Waze route calculator"""
 
+import collections
+import functools
+import json
 import logging
 import requests
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from .cache import geocode_key
+from .places import bounds_box, inside_bounds
+from .route import Route
+from .scheduler import PRIORITY_INTERACTIVE
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+TimeSeries = collections.namedtuple('TimeSeries', 'series best window')
 
 
 class WRCError(Exception):
     def __init__(self, message):
+        super(WRCError, self).__init__(message)  # args make it picklable for worker processes
         self.message = message
 
     def __str__(self):
@@ -41,14 +67,65 @@ class WazeRouteCalculator(object):
         'IL': 'https://routing-livemap-il.waze.com/RoutingManager/routingRequest',
         'AU': 'https://routing-livemap-row.waze.com/RoutingManager/routingRequest'
     }
+    ALTERNATE_ROUTING_SERVERS = {}  # region: [routing servers that can also serve it], for session failover
+    HTTP_TIMEOUT = 60  # seconds, without session
+    VECTORIZE_MIN_SEGMENTS = None  # opt-in: add up Route columns with numpy from this many segments
     COORD_MATCH = re.compile(r'^([-+]?)([\d]{1,2})(((\.)(\d+)(,)))(\s*)(([-+]?)([\d]{1,3})((\.)(\d+))?)$')
 
-    def __init__(self, start_address, end_address, region='EU', vehicle_type='', avoid_toll_roads=False, avoid_subscription_roads=False, avoid_ferries=False, log_lvl=None):
+    def __init__(self, start_address, end_address, region='EU', vehicle_type='', avoid_toll_roads=False, avoid_subscription_roads=False, avoid_ferries=False, log_lvl=None, geocode_cache=None, session=None, lazy=False, route_cache=None, summary_only=False, hooks=None, scheduler=None, priority=PRIORITY_INTERACTIVE, single_flight=None, place_index=None, backend=None):
         self.log = logging.getLogger(__name__)
         self.log.addHandler(logging.NullHandler())
         if log_lvl:
             self.log.warning("log_lvl is deprecated please check example.py ")
         self.log.info("From: %s - to: %s", start_address, end_address)
+        self._set_options(region, vehicle_type, avoid_toll_roads, avoid_subscription_roads, avoid_ferries, geocode_cache, session, route_cache, summary_only, hooks, scheduler, priority, single_flight, place_index, backend)
+        self.start_address = start_address
+        self.end_address = end_address
+        self._start_coords = None
+        self._end_coords = None
+        if not lazy:
+            self.start_coords = self.resolve(start_address)
+            self.log.debug('Start coords: (%s, %s)', self.start_coords["lat"], self.start_coords["lon"])
+            self.end_coords = self.resolve(end_address)
+            self.log.debug('End coords: (%s, %s)', self.end_coords["lat"], self.end_coords["lon"])
+
+    @property
+    def start_coords(self):
+        """Start coordinates, resolved on first use in lazy mode"""
+
+        if self._start_coords is None:
+            self._start_coords = self.resolve(self.start_address)
+            self.log.debug('Start coords: (%s, %s)', self._start_coords["lat"], self._start_coords["lon"])
+        return self._start_coords
+
+    @start_coords.setter
+    def start_coords(self, coords):
+        self._start_coords = coords
+
+    @property
+    def end_coords(self):
+        """End coordinates, resolved on first use in lazy mode"""
+
+        if self._end_coords is None:
+            self._end_coords = self.resolve(self.end_address)
+            self.log.debug('End coords: (%s, %s)', self._end_coords["lat"], self._end_coords["lon"])
+        return self._end_coords
+
+    @end_coords.setter
+    def end_coords(self, coords):
+        self._end_coords = coords
+
+    def resolve_endpoints(self):
+        """Resolve start and end address concurrently if neither is resolved yet"""
+
+        if self._start_coords is None and self._end_coords is None:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                start_coords = executor.submit(self.resolve, self.start_address)
+                end_coords = executor.submit(self.resolve, self.end_address)
+                self.start_coords, self.end_coords = start_coords.result(), end_coords.result()
+        return self.start_coords, self.end_coords
+
+    def _set_options(self, region, vehicle_type, avoid_toll_roads, avoid_subscription_roads, avoid_ferries, geocode_cache, session, route_cache, summary_only, hooks, scheduler=None, priority=PRIORITY_INTERACTIVE, single_flight=None, place_index=None, backend=None):
         region = region.upper()
         if region == 'NA':  # North America
             region = 'US'
@@ -62,32 +139,87 @@ class WazeRouteCalculator(object):
             'AVOID_FERRIES': 't' if avoid_ferries else 'f'
         }
         self.avoid_subscription_roads = avoid_subscription_roads
-        if self.already_coords(start_address):  # See if we have coordinates or address to resolve
-            self.start_coords = self.coords_string_parser(start_address)
-        else:
-            self.start_coords = self.address_to_coords(start_address)
-        self.log.debug('Start coords: (%s, %s)', self.start_coords["lat"], self.start_coords["lon"])
-        if self.already_coords(end_address):  # See if we have coordinates or address to resolve
-            self.end_coords = self.coords_string_parser(end_address)
-        else:
-            self.end_coords = self.address_to_coords(end_address)
-        self.log.debug('End coords: (%s, %s)', self.end_coords["lat"], self.end_coords["lon"])
+        self.geocode_cache = geocode_cache
+        self.session = session
+        self.route_cache = route_cache
+        self.summary_only = summary_only
+        self.hooks = hooks
+        self.scheduler = scheduler
+        self.priority = priority
+        self.single_flight = single_flight
+        self.place_index = place_index
+        self.backend = backend
+
+    def resolve(self, address):
+        """Return coordinates for address, coordinate string or already resolved coords dict"""
+
+        if isinstance(address, dict):
+            return address
+        if self.already_coords(address):  # See if we have coordinates or address to resolve
+            return self._snap(self.coords_string_parser(address))
+        return self.address_to_coords(address)
+
+    def _snap(self, coords):
+        """Take bounds of parsed coordinates from the place index"""
+
+        if self.place_index is not None:
+            return self.place_index.snap(coords)
+        return coords
 
     def already_coords(self, address):
         """test used to see if we have coordinates or address"""
 
-        m = re.search(self.COORD_MATCH, address)
-        return (m is not None)
+        return self.COORD_MATCH.match(address) is not None
 
     def coords_string_parser(self, coords):
         """Pareses the address string into coordinates to match address_to_coords return object"""
 
         lat, lon = coords.split(',')
-        return {"lat": lat.strip(), "lon": lon.strip(), "bounds": {}}
+        return {"lat": float(lat), "lon": float(lon), "bounds": {}}
 
     def address_to_coords(self, address):
         """Convert address to coordinates"""
 
+        start = time.perf_counter()
+        try:
+            coords = self._cached_coords(address)
+            if coords is None:
+                if self.single_flight is not None:
+                    coords = self.single_flight.do(('geocode', self.region, address), lambda: self._geocode(address))
+                else:
+                    coords = self._geocode(address)
+        finally:
+            self._phase_done('geocode', start)
+        return coords
+
+    def _geocode(self, address):
+        response = self._http_get(*self._geocode_request(address), endpoint='geocode')
+        return self._geocode_response(response, address)
+
+    def _geocode_response(self, response, address):
+        """Decode address search response, bad answers raise WRCError"""
+
+        if not response.ok:
+            raise WRCError("Cannot get coords for %s: HTTP %s" % (address, response.status_code))
+        start = time.perf_counter()
+        try:
+            response_json = _json_loads(response.content)
+        except ValueError:
+            raise WRCError("Cannot get coords for %s: invalid response" % address)
+        finally:
+            self._phase_done('geocode_decode', start)
+        return self._parse_coords(response_json, address)
+
+    def _cached_coords(self, address):
+        if self.geocode_cache is not None:
+            coords = self.geocode_cache.get(geocode_key(address, self.region))
+            if coords is not None:
+                self.log.debug('Geocode cache hit: %s', address)
+            return coords
+
+    def _geocode_request(self, address):
+        """Build url and query parameters for address search"""
+
         base_coords = self.BASE_COORDS[self.region]
         get_cord = self.COORD_SERVERS[self.region]
         url_options = {
@@ -97,9 +229,26 @@ class WazeRouteCalculator(object):
             "lat": base_coords["lat"],
             "lon": base_coords["lon"]
         }
+        return self.WAZE_URL + get_cord, url_options
+
+    def _parse_coords(self, places, address):
+        """Pick the first city from address search results"""
+
+        try:
+            coords = self._first_city(places)
+        except (KeyError, IndexError, TypeError, AttributeError):
+            raise WRCError("Cannot get coords for %s: wrong response" % address)
+        if coords is not None:
+            if self.geocode_cache is not None:
+                self.geocode_cache.set(geocode_key(address, self.region), coords)
+            if self.place_index is not None:
+                self.place_index.add(address, coords)
+            return coords
+        raise WRCError("Cannot get coords for %s" % address)
 
-        response = requests.get(self.WAZE_URL + get_cord, params=url_options, headers=self.HEADERS)
-        for response_json in response.json():
+    @staticmethod
+    def _first_city(places):
+        for response_json in places:
             if response_json.get('city'):
                 lat = response_json['location']['lat']
                 lon = response_json['location']['lon']
@@ -110,11 +259,57 @@ class WazeRouteCalculator(object):
                 else:
                     bounds = {}
                 return {"lat": lat, "lon": lon, "bounds": bounds}
-        raise WRCError("Cannot get coords for %s" % address)
+        return None
 
     def get_route(self, npaths=1, time_delta=0):
         """Get route data from waze"""
 
+        self.resolve_endpoints()
+        start = time.perf_counter()
+        routing_server, url_options = self._route_request(npaths, time_delta)
+        try:
+            if self.route_cache is not None:
+                cache_key = self.route_cache.key(routing_server, url_options)
+                route = self.route_cache.get_or_fetch(cache_key, lambda: self._fetch_route(routing_server, url_options, npaths))
+            elif self.single_flight is not None:
+                flight_key = ('routing', routing_server, tuple(sorted(url_options.items())))
+                route = self.single_flight.do(flight_key, lambda: self._fetch_route(routing_server, url_options, npaths))
+            else:
+                route = self._fetch_route(routing_server, url_options, npaths)
+        finally:
+            self._phase_done('routing', start)
+        return route
+
+    def get_routes(self, npaths=3, time_delta=0, keep_raw=False):
+        """Get routes from waze as list of compact Route objects"""
+
+        return self._routes(self.get_route(npaths, time_delta), keep_raw)
+
+    @staticmethod
+    def _routes(routes, keep_raw):
+        if not isinstance(routes, list):
+            routes = [routes]
+        try:
+            return [Route.from_dict(route, keep_raw) for route in routes]
+        except KeyError:
+            raise WRCError("wrong response")
+
+    def _alternates(self, routing_server):
+        """Routing servers to fail over to, only the ones configured for the region"""
+
+        return [server for server in self.ALTERNATE_ROUTING_SERVERS.get(self.region, ()) if server != routing_server]
+
+    def _fetch_route(self, routing_server, url_options, npaths):
+        response = self._http_get(routing_server, url_options, endpoint='routing', alternates=self._alternates(routing_server))
+        response.encoding = 'utf-8'
+        start = time.perf_counter()
+        response_json = self._check_response(response)
+        self._phase_done('routing_decode', start)
+        return self._parse_route(response_json, npaths)
+
+    def _route_request(self, npaths, time_delta):
+        """Build url and query parameters for routing request"""
+
         routing_server = self.ROUTING_SERVERS[self.region]
 
         url_options = {
@@ -122,8 +317,8 @@ class WazeRouteCalculator(object):
             "to": "x:%s y:%s" % (self.end_coords["lon"], self.end_coords["lat"]),
             "at": time_delta,
             "returnJSON": "true",
-            "returnGeometries": "true",
-            "returnInstructions": "true",
+            "returnGeometries": "false" if self.summary_only else "true",
+            "returnInstructions": "false" if self.summary_only else "true",
             "timeout": 60000,
             "nPaths": npaths,
             "options": ','.join('%s:%s' % (opt, value) for (opt, value) in self.ROUTE_OPTIONS.items()),
@@ -133,56 +328,120 @@ class WazeRouteCalculator(object):
         # Handle vignette system in Europe. Defaults to false (show all routes)
         if self.avoid_subscription_roads is False:
             url_options["subscription"] = "*"
+        return routing_server, url_options
+
+    @staticmethod
+    def _parse_route(response_json, npaths):
+        """Extract route or list of routes from routing response"""
 
-        response = requests.get(routing_server, params=url_options, headers=self.HEADERS)
-        response.encoding = 'utf-8'
-        response_json = self._check_response(response)
         if response_json:
+            if not isinstance(response_json, dict):
+                raise WRCError("wrong response")
             if 'error' in response_json:
                 raise WRCError(response_json.get("error"))
-            else:
+            try:
                 if response_json.get("alternatives"):
-                    return [alt['response'] for alt in response_json['alternatives']]
+                    return [WazeRouteCalculator._with_coords(alt['response'], alt) for alt in response_json['alternatives']]
                 response_obj = response_json['response']
                 if isinstance(response_obj, list):
                     response_obj = response_obj[0]
-                if npaths > 1:
-                    return [response_obj]
-                return response_obj
+                response_obj = WazeRouteCalculator._with_coords(response_obj, response_json)
+            except (KeyError, IndexError, TypeError):
+                raise WRCError("wrong response")
+            if npaths > 1:
+                return [response_obj]
+            return response_obj
         else:
             raise WRCError("empty response")
 
+    @staticmethod
+    def _with_coords(route, parent):
+        """Put the route geometry, sent next to the route, into the route dict by reference"""
+
+        coords = parent.get('coords')
+        if coords and isinstance(route, dict) and 'coords' not in route:
+            route['coords'] = coords
+        return route
+
+    def _http_get(self, url, params, endpoint, alternates=()):
+        """Send request through the shared session if there is one, the session can fail over to alternates.
+
+        With a scheduler every request waits for its turn first, the session
+        takes a turn for each of its retries and hedged requests too.
+        """
+
+        start = time.perf_counter()
+        try:
+            if self.session is not None:
+                options = {}
+                if alternates:
+                    options['alternates'] = alternates
+                if self.scheduler is not None:
+                    options['acquire'] = functools.partial(self.scheduler.acquire, endpoint, self.priority)
+                response = self.session.get(url, params=params, headers=self.HEADERS, **options)
+            else:
+                if self.scheduler is not None:
+                    self.scheduler.acquire(endpoint, self.priority)
+                response = requests.get(url, params=params, headers=self.HEADERS, timeout=self.HTTP_TIMEOUT)
+        except Exception as err:
+            self._request_done(endpoint, start, error=err)
+            raise
+        self._request_done(endpoint, start, response)
+        return response
+
+    def _request_done(self, endpoint, start, response=None, error=None):
+        """Report a request to the hooks, a failed one with the exception name as status"""
+
+        if self.hooks is None:
+            return
+        duration = time.perf_counter() - start
+        if error is not None:
+            self.hooks.on_request(endpoint, duration, type(error).__name__, 0, getattr(error, 'retries', 0))
+        else:
+            self.hooks.on_request(endpoint, duration, response.status_code, len(response.content), getattr(response, 'retries', 0))
+
+    def _phase_done(self, phase, start):
+        if self.hooks is not None:
+            self.hooks.on_phase(phase, time.perf_counter() - start)
+
     @staticmethod
     def _check_response(response):
         """Check waze server response."""
         if response.ok:
             try:
-                return response.json()
+                return _json_loads(response.content)
             except ValueError:
                 return None
 
     def _add_up_route(self, results, real_time=True, stop_at_bounds=False):
         """Calculate route time and distance."""
 
-        start_bounds = self.start_coords['bounds']
-        end_bounds = self.end_coords['bounds']
+        start = time.perf_counter()
+        summary = self._add_up_segments(results, real_time, stop_at_bounds)
+        if self.hooks is not None:
+            self.hooks.on_phase('add_up', time.perf_counter() - start)
+            self.hooks.on_segments(len(results))
+        return summary
+
+    def _add_up_segments(self, results, real_time, stop_at_bounds):
+        if isinstance(results, Route):
+            if numpy is not None and self.VECTORIZE_MIN_SEGMENTS is not None and len(results) >= self.VECTORIZE_MIN_SEGMENTS:
+                summary = self._add_up_route_numpy(results, real_time, stop_at_bounds)
+                if summary is not None:
+                    return summary
+            if stop_at_bounds:
+                return results.total(real_time, self.start_coords['bounds'], self.end_coords['bounds'])
+            return results.total(real_time)
 
-        def between(target, min, max):
-            return target > min and target < max
+        start_box = bounds_box(self.start_coords['bounds'])
+        end_box = bounds_box(self.end_coords['bounds'])
 
         time = 0
         distance = 0
         for segment in results:
             if stop_at_bounds and segment.get('path'):
-                x = segment['path']['x']
-                y = segment['path']['y']
-                if (
-                    between(x, start_bounds.get('left', 0), start_bounds.get('right', 0)) or
-                    between(x, end_bounds.get('left', 0), end_bounds.get('right', 0))
-                ) and (
-                    between(y, start_bounds.get('bottom', 0), start_bounds.get('top', 0)) or
-                    between(y, end_bounds.get('bottom', 0), end_bounds.get('top', 0))
-                ):
+                path = segment['path']
+                if inside_bounds(path['x'], path['y'], start_box, end_box):
                     continue
             if 'crossTime' in segment:
                 time += segment['crossTime' if real_time else 'crossTimeWithoutRealTime']
@@ -193,22 +452,113 @@ class WazeRouteCalculator(object):
         route_distance = distance / 1000.0
         return route_time, route_distance
 
+    def _add_up_route_numpy(self, route, real_time, stop_at_bounds):
+        """Route.total on the array columns of route without copying them, None if a kept segment misses its time"""
+
+        times = numpy.frombuffer(route.cross_time if real_time else route.cross_time_without_real_time)
+        lengths = numpy.frombuffer(route.length)
+        if stop_at_bounds and (self.start_coords['bounds'] or self.end_coords['bounds']):
+            start_box = bounds_box(self.start_coords['bounds'])
+            end_box = bounds_box(self.end_coords['bounds'])
+            x = numpy.frombuffer(route.x)
+            y = numpy.frombuffer(route.y)
+            inside = (
+                ((x > start_box[0]) & (x < start_box[1])) | ((x > end_box[0]) & (x < end_box[1]))
+            ) & (
+                ((y > start_box[2]) & (y < start_box[3])) | ((y > end_box[2]) & (y < end_box[3]))
+            )
+            times = times[~inside]
+            lengths = lengths[~inside]
+        if numpy.isnan(times).any():
+            return None
+        # cumsum adds up in order, so the totals match Route.total exactly
+        time = numpy.cumsum(times)[-1] if len(times) else 0.0
+        distance = numpy.cumsum(lengths)[-1] if len(lengths) else 0.0
+        return float(time) / 60.0, float(distance) / 1000.0
+
     def calc_route_info(self, real_time=True, stop_at_bounds=False, time_delta=0):
         """Calculate best route info."""
 
+        if self.backend is not None:
+            return self._backend_info(1, real_time, stop_at_bounds, time_delta, False)
         route = self.get_route(1, time_delta)
-        results = route['results' if 'results' in route else 'result']
-        route_time, route_distance = self._add_up_route(results, real_time=real_time, stop_at_bounds=stop_at_bounds)
+        return self._route_info(route, real_time, stop_at_bounds)
+
+    def _backend_info(self, npaths, real_time, stop_at_bounds, time_delta, all_routes):
+        """Send the raw routing response to the backend for decoding and adding up"""
+
+        self.resolve_endpoints()
+        start = time.perf_counter()
+        routing_server, url_options = self._route_request(npaths, time_delta)
+        try:
+            response = self._http_get(routing_server, url_options, endpoint='routing', alternates=self._alternates(routing_server))
+            return self.backend.summarize(response.status_code, response.content, npaths, real_time, stop_at_bounds, self.start_coords['bounds'], self.end_coords['bounds'], all_routes)
+        finally:
+            self._phase_done('routing', start)
+
+    def _route_info(self, route, real_time, stop_at_bounds):
+        route_time, route_distance = self._route_total(route, real_time, stop_at_bounds)
         self.log.info('Time %.2f minutes, distance %.2f km.', route_time, route_distance)
         return route_time, route_distance
 
+    def _route_total(self, route, real_time, stop_at_bounds):
+        """(time, distance) of a route dict, WRCError if it has no usable segments"""
+
+        try:
+            results = route['results' if 'results' in route else 'result']
+            return self._add_up_route(results, real_time=real_time, stop_at_bounds=stop_at_bounds)
+        except (KeyError, TypeError):
+            raise WRCError("wrong response")
+
     def calc_all_routes_info(self, npaths=3, real_time=True, stop_at_bounds=False, time_delta=0):
         """Calculate all route infos."""
 
+        if self.backend is not None:
+            return self._backend_info(npaths, real_time, stop_at_bounds, time_delta, True)
         routes = self.get_route(npaths, time_delta)
+        return self._all_routes_info(routes, real_time, stop_at_bounds)
+
+    def calc_route_time_series(self, deltas, real_time=True, stop_at_bounds=False, max_workers=4, tolerance=0.05):
+        """Calculate best route info for several leave times concurrently.
+
+        Returns TimeSeries with series of (time_delta, route_time, route_distance)
+        in the order of deltas, the best (fastest) entry and the window
+        (first, last time_delta) around it where route time stays within
+        tolerance of the best. Without deltas best and window are None.
+        """
+
+        deltas = list(deltas)
+        if not deltas:
+            return self._time_series([], tolerance)
+        self.resolve_endpoints()
+
+        def calc(time_delta):
+            return (time_delta,) + self._route_total(self.get_route(1, time_delta), real_time, stop_at_bounds)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            series = list(executor.map(calc, deltas))
+        return self._time_series(series, tolerance)
+
+    def _time_series(self, series, tolerance):
+        """TimeSeries of series with the best entry and the window around it"""
+
+        if not series:
+            return TimeSeries([], None, None)
+        best_index = min(range(len(series)), key=lambda index: series[index][1])
+        best = series[best_index]
+        limit = best[1] * (1 + tolerance)
+        first = last = best_index
+        while first > 0 and series[first - 1][1] <= limit:
+            first -= 1
+        while last < len(series) - 1 and series[last + 1][1] <= limit:
+            last += 1
+        self.log.info('Best leave time %s minutes from now, %.2f minutes, %.2f km.', *best)
+        return TimeSeries(series, best, (series[first][0], series[last][0]))
+
+    def _all_routes_info(self, routes, real_time, stop_at_bounds):
         try:
             results = {"%s-%s" % (''.join(route.get('routeType', [])[:1]), route.get('shortRouteName', 'unkown')): self._add_up_route(route['results' if 'results' in route else 'result'], real_time=real_time, stop_at_bounds=stop_at_bounds) for route in routes}
-        except KeyError:
+        except (KeyError, TypeError, AttributeError):
             raise WRCError("wrong response")
         route_time = [route[0] for route in results.values()]
         route_distance = [route[1] for route in results.values()]
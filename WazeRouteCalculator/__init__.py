@@ -1,2 +1,18 @@
 from .__version__ import __version__
 from .WazeRouteCalculator import *
+from .cache import MemoryCache, RouteCache, SQLiteCache
+from .session import WazeSession
+from .batch import MultiStopRoute, RouteMatrix, calc_multi_stop_route, calc_route_matrix, resolve_inputs
+from .aio import AsyncWazeRouteCalculator, AsyncWazeSession
+from .route import Route
+from .geometry import Geometry, decode_polyline, encode_polyline
+from .hooks import Hooks, PrometheusHooks, StatsCollector
+from .optimize import StopOrder, optimize_stop_order
+from .scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, RequestScheduler, TokenBucket
+from .inputs import NormalizedInputs, normalize_inputs
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .places import PlaceIndex
+from .isochrone import Isochrone, calc_isochrone
+from .tracker import RouteTracker
+from .backends import ProcessBackend
+from .replay import RecordingSession, ReplaySession
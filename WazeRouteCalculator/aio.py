@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Asyncio Waze route calculator"""
+
+import asyncio
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from .WazeRouteCalculator import WazeRouteCalculator, WRCError, _json_loads
+from .scheduler import PRIORITY_INTERACTIVE
+
+
+class AsyncResponse(object):
+    """Buffered HTTP response, quacks like requests.Response for the parsers"""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.encoding = 'utf-8'
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return _json_loads(self.content)
+
+
+class AsyncWazeSession(object):
+    """Pooled aiohttp client with a limit on in-flight requests"""
+
+    def __init__(self, limit=100, timeout=60, client=None):
+        self.limit = limit
+        self.timeout = timeout
+        self._client = client
+        self._semaphore = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            if aiohttp is None:
+                raise WRCError("aiohttp is required for AsyncWazeSession")
+            self._client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._client
+
+    async def get(self, url, params=None, headers=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        params = dict((key, str(value)) for key, value in (params or {}).items())
+        async with self._semaphore:
+            async with self.client.get(url, params=params, headers=headers) as response:
+                return AsyncResponse(response.status, await response.read())
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class AsyncWazeRouteCalculator(WazeRouteCalculator):
+    """Calculate actual route time and distance with Waze API from asyncio code.
+
+    Addresses are always resolved lazily, on the first route request or with resolve_endpoints().
+    Every method that sends requests is a coroutine. scheduler waits and
+    backend work run in the default executor, off the event loop.
+    """
+
+    def __init__(self, start_address, end_address, region='EU', vehicle_type='', avoid_toll_roads=False, avoid_subscription_roads=False, avoid_ferries=False, geocode_cache=None, session=None, route_cache=None, summary_only=False, hooks=None, scheduler=None, priority=PRIORITY_INTERACTIVE, single_flight=None, place_index=None, backend=None):
+        self.log = logging.getLogger(__name__)
+        self.log.addHandler(logging.NullHandler())
+        self.log.info("From: %s - to: %s", start_address, end_address)
+        self._own_session = session is None
+        if session is None:
+            session = AsyncWazeSession()
+        self._set_options(region, vehicle_type, avoid_toll_roads, avoid_subscription_roads, avoid_ferries, geocode_cache, session, route_cache, summary_only, hooks, scheduler, priority, single_flight, place_index, backend)
+        self.start_address = start_address
+        self.end_address = end_address
+        self._start_coords = None
+        self._end_coords = None
+
+    @property
+    def start_coords(self):
+        """Start coordinates, None until resolve_endpoints() is awaited"""
+
+        return self._start_coords
+
+    @start_coords.setter
+    def start_coords(self, coords):
+        self._start_coords = coords
+
+    @property
+    def end_coords(self):
+        """End coordinates, None until resolve_endpoints() is awaited"""
+
+        return self._end_coords
+
+    @end_coords.setter
+    def end_coords(self, coords):
+        self._end_coords = coords
+
+    async def resolve(self, address):
+        """Return coordinates for address, coordinate string or already resolved coords dict"""
+
+        if isinstance(address, dict):
+            return address
+        if self.already_coords(address):
+            return self._snap(self.coords_string_parser(address))
+        return await self.address_to_coords(address)
+
+    async def resolve_endpoints(self):
+        """Resolve start and end address concurrently"""
+
+        if self.start_coords is None or self.end_coords is None:
+            self.start_coords, self.end_coords = await asyncio.gather(self.resolve(self.start_address), self.resolve(self.end_address))
+            self.log.debug('Start coords: (%s, %s)', self.start_coords["lat"], self.start_coords["lon"])
+            self.log.debug('End coords: (%s, %s)', self.end_coords["lat"], self.end_coords["lon"])
+
+    async def address_to_coords(self, address):
+        """Convert address to coordinates"""
+
+        start = time.perf_counter()
+        try:
+            coords = self._cached_coords(address)
+            if coords is None:
+                if self.single_flight is not None:
+                    coords = await self.single_flight.do(('geocode', self.region, address), lambda: self._geocode(address))
+                else:
+                    coords = await self._geocode(address)
+        finally:
+            self._phase_done('geocode', start)
+        return coords
+
+    async def _geocode(self, address):
+        response = await self._http_get(*self._geocode_request(address), endpoint='geocode')
+        return self._geocode_response(response, address)
+
+    async def get_route(self, npaths=1, time_delta=0):
+        """Get route data from waze"""
+
+        await self.resolve_endpoints()
+        start = time.perf_counter()
+        routing_server, url_options = self._route_request(npaths, time_delta)
+        try:
+            return await self._cached_route(routing_server, url_options, npaths)
+        finally:
+            self._phase_done('routing', start)
+
+    async def _cached_route(self, routing_server, url_options, npaths):
+        if self.route_cache is not None:
+            cache_key = self.route_cache.key(routing_server, url_options)
+            return await self.route_cache.get_or_fetch_async(cache_key, lambda: self._fetch_route(routing_server, url_options, npaths))
+        if self.single_flight is not None:
+            flight_key = ('routing', routing_server, tuple(sorted(url_options.items())))
+            return await self.single_flight.do(flight_key, lambda: self._fetch_route(routing_server, url_options, npaths))
+        return await self._fetch_route(routing_server, url_options, npaths)
+
+    async def get_routes(self, npaths=3, time_delta=0, keep_raw=False):
+        """Get routes from waze as list of compact Route objects"""
+
+        return self._routes(await self.get_route(npaths, time_delta), keep_raw)
+
+    async def _fetch_route(self, routing_server, url_options, npaths):
+        response = await self._http_get(routing_server, url_options, endpoint='routing')
+        start = time.perf_counter()
+        response_json = self._check_response(response)
+        self._phase_done('routing_decode', start)
+        return self._parse_route(response_json, npaths)
+
+    async def _http_get(self, url, params, endpoint):
+        if self.scheduler is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.scheduler.acquire, endpoint, self.priority)
+        start = time.perf_counter()
+        try:
+            response = await self.session.get(url, params=params, headers=self.HEADERS)
+        except Exception as err:
+            self._request_done(endpoint, start, error=err)
+            raise
+        self._request_done(endpoint, start, response)
+        return response
+
+    async def calc_route_info(self, real_time=True, stop_at_bounds=False, time_delta=0):
+        """Calculate best route info."""
+
+        if self.backend is not None:
+            return await self._backend_info(1, real_time, stop_at_bounds, time_delta, False)
+        route = await self.get_route(1, time_delta)
+        return self._route_info(route, real_time, stop_at_bounds)
+
+    async def _backend_info(self, npaths, real_time, stop_at_bounds, time_delta, all_routes):
+        await self.resolve_endpoints()
+        start = time.perf_counter()
+        routing_server, url_options = self._route_request(npaths, time_delta)
+        try:
+            response = await self._http_get(routing_server, url_options, endpoint='routing')
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.backend.summarize, response.status_code, response.content, npaths, real_time, stop_at_bounds,
+                self.start_coords['bounds'], self.end_coords['bounds'], all_routes)
+        finally:
+            self._phase_done('routing', start)
+
+    async def calc_all_routes_info(self, npaths=3, real_time=True, stop_at_bounds=False, time_delta=0):
+        """Calculate all route infos."""
+
+        if self.backend is not None:
+            return await self._backend_info(npaths, real_time, stop_at_bounds, time_delta, True)
+        routes = await self.get_route(npaths, time_delta)
+        return self._all_routes_info(routes, real_time, stop_at_bounds)
+
+    async def calc_route_time_series(self, deltas, real_time=True, stop_at_bounds=False, max_workers=4, tolerance=0.05):
+        """Calculate best route info for several leave times concurrently, max_workers at a time.
+
+        Returns TimeSeries like WazeRouteCalculator.calc_route_time_series.
+        """
+
+        deltas = list(deltas)
+        if not deltas:
+            return self._time_series([], tolerance)
+        await self.resolve_endpoints()
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def calc(time_delta):
+            async with semaphore:
+                route = await self.get_route(1, time_delta)
+            return (time_delta,) + self._route_total(route, real_time, stop_at_bounds)
+
+        series = await asyncio.gather(*[calc(time_delta) for time_delta in deltas])
+        return self._time_series(series, tolerance)
+
+    async def close(self):
+        """Close the session if the calculator created it"""
+
+        if self._own_session:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
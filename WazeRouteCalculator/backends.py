@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Process pool backend for decoding and adding up routing responses"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from .WazeRouteCalculator import WazeRouteCalculator
+
+
+class RawResponse(object):
+    """Status code and body of a routing response, enough for _check_response"""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+
+def summarize_response(status_code, content, npaths, real_time, stop_at_bounds, start_bounds, end_bounds, all_routes):
+    """Decode a routing response and add up its routes like calc_route_info or calc_all_routes_info"""
+
+    calculator = WazeRouteCalculator({"lat": 0, "lon": 0, "bounds": start_bounds}, {"lat": 0, "lon": 0, "bounds": end_bounds}, lazy=True)
+    response_json = calculator._check_response(RawResponse(status_code, content))
+    routes = calculator._parse_route(response_json, npaths)
+    if all_routes:
+        return calculator._all_routes_info(routes, real_time, stop_at_bounds)
+    return calculator._route_info(routes, real_time, stop_at_bounds)
+
+
+class ProcessBackend(object):
+    """Ship raw routing responses to worker processes, only the (time, distance) summaries come back.
+
+    Pass it as backend to the calculator, calc_route_info and
+    calc_all_routes_info then skip the route cache and single flight.
+    """
+
+    def __init__(self, max_workers=None, mp_context=None):
+        self.max_workers = max_workers
+        self.mp_context = mp_context
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.mp_context)
+            return self._executor
+
+    def summarize(self, status_code, content, npaths, real_time, stop_at_bounds, start_bounds, end_bounds, all_routes):
+        """Run summarize_response in a worker process and wait for it"""
+
+        future = self._get_executor().submit(summarize_response, status_code, content, npaths, real_time, stop_at_bounds, start_bounds, end_bounds, all_routes)
+        return future.result()
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Batch route calculations"""
+
+import collections
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .WazeRouteCalculator import WazeRouteCalculator, WRCError
+from .inputs import normalize_inputs
+from .scheduler import PRIORITY_BULK
+
+
+RouteMatrix = collections.namedtuple('RouteMatrix', 'times distances errors')
+MultiStopRoute = collections.namedtuple('MultiStopRoute', 'legs time distance')
+
+
+def _call(func, *args, **kwargs):
+    """Run func, return (result, error) where error is a WRCError"""
+
+    try:
+        return func(*args, **kwargs), None
+    except WRCError as err:
+        return None, err
+    except requests.RequestException as err:
+        return None, WRCError(str(err))
+
+
+def geocode_unique(addresses, region='EU', max_workers=8, **kwargs):
+    """Resolve every distinct address once, return ({address: coords}, {address: WRCError}).
+
+    Coordinate strings are parsed in place, only real addresses go to the geocoder.
+    """
+
+    addresses = list(addresses)
+    inputs = normalize_inputs(addresses)
+    coords = {}
+    for address, lat, lon, index in zip(addresses, inputs.lat, inputs.lon, inputs.address_index):
+        if index < 0:
+            coords[address] = {"lat": lat, "lon": lon, "bounds": {}}
+    errors = {}
+    if not inputs.addresses:
+        return coords, errors
+    geocoder = WazeRouteCalculator(None, None, region, lazy=True, **kwargs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for address, (result, error) in zip(inputs.addresses, executor.map(lambda address: _call(geocoder.address_to_coords, address), inputs.addresses)):
+            if error is None:
+                coords[address] = result
+            else:
+                errors[address] = error
+    return coords, errors
+
+
+def resolve_inputs(values, region='EU', max_workers=8, **kwargs):
+    """Normalize a column of addresses and coordinate strings and geocode the distinct addresses.
+
+    Returns (NormalizedInputs, {address: WRCError}), lat and lon are filled in
+    for every resolved row and stay NaN where geocoding failed.
+    """
+
+    inputs = normalize_inputs(values)
+    coords, errors = geocode_unique(inputs.addresses, region, max_workers, **kwargs)
+    lat = [coords[address]["lat"] if address in coords else float('nan') for address in inputs.addresses]
+    lon = [coords[address]["lon"] if address in coords else float('nan') for address in inputs.addresses]
+    for row, index in enumerate(inputs.address_index):
+        if index >= 0:
+            inputs.lat[row] = lat[index]
+            inputs.lon[row] = lon[index]
+    return inputs, errors
+
+
+ROUTE_OPTION_ARGS = ('vehicle_type', 'avoid_toll_roads', 'avoid_subscription_roads', 'avoid_ferries')
+
+
+def pair_key(origin, destination, region='EU', real_time=True, stop_at_bounds=False, time_delta=0, **kwargs):
+    """Cache key of an origin - destination result with the options changing it"""
+
+    options = [kwargs.get(name) for name in ROUTE_OPTION_ARGS]
+    return json.dumps([region.upper(), origin, destination, real_time, stop_at_bounds, time_delta] + options)
+
+
+def calc_route_matrix(origins, destinations, region='EU', real_time=True, stop_at_bounds=False, time_delta=0, max_workers=8, pair_cache=None, **kwargs):
+    """Calculate route time and distance for every origin - destination pair.
+
+    Every distinct address is geocoded once, routes are requested on a thread pool.
+    With pair_cache (MemoryCache or SQLiteCache) cells found in it are not requested again.
+    Returns RouteMatrix with times (minutes) and distances (km) as lists of rows,
+    failed cells are None and their WRCError is in errors[(row, col)].
+    Requests go with bulk priority through a scheduler unless priority is given.
+    """
+
+    kwargs.setdefault('priority', PRIORITY_BULK)
+    origins = list(origins)
+    destinations = list(destinations)
+    times = [[None] * len(destinations) for _ in origins]
+    distances = [[None] * len(destinations) for _ in origins]
+    errors = {}
+
+    cells = []
+    for i, origin in enumerate(origins):
+        for j, destination in enumerate(destinations):
+            if origin == destination:
+                times[i][j], distances[i][j] = 0.0, 0.0
+                continue
+            if pair_cache is not None:
+                cached = pair_cache.get(pair_key(origin, destination, region, real_time, stop_at_bounds, time_delta, **kwargs))
+                if cached is not None:
+                    times[i][j], distances[i][j] = cached
+                    continue
+            cells.append((i, j))
+    if not cells:
+        return RouteMatrix(times, distances, errors)
+
+    addresses = [origins[i] for i, j in cells] + [destinations[j] for i, j in cells]
+    coords, geocode_errors = geocode_unique(addresses, region, max_workers, **kwargs)
+
+    def calc_cell(origin, destination):
+        route = WazeRouteCalculator(coords[origin], coords[destination], region, **kwargs)
+        return route.calc_route_info(real_time=real_time, stop_at_bounds=stop_at_bounds, time_delta=time_delta)
+
+    routed = []
+    for i, j in cells:
+        error = geocode_errors.get(origins[i]) or geocode_errors.get(destinations[j])
+        if error is not None:
+            errors[(i, j)] = error
+        else:
+            routed.append((i, j))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda cell: _call(calc_cell, origins[cell[0]], destinations[cell[1]]), routed)
+        for (i, j), (result, error) in zip(routed, results):
+            if error is None:
+                times[i][j], distances[i][j] = result
+                if pair_cache is not None:
+                    pair_cache.set(pair_key(origins[i], destinations[j], region, real_time, stop_at_bounds, time_delta, **kwargs), list(result))
+            else:
+                errors[(i, j)] = error
+    return RouteMatrix(times, distances, errors)
+
+
+def calc_multi_stop_route(stops, region='EU', real_time=True, stop_at_bounds=False, time_delta=0, max_workers=8, **kwargs):
+    """Calculate route through stops in the given order.
+
+    Every distinct stop is geocoded once and the legs are requested concurrently,
+    all of them leaving at time_delta. stop_at_bounds applies to each leg.
+    Returns MultiStopRoute with legs as (route_time, route_distance) tuples and
+    the total time (minutes) and distance (km).
+    """
+
+    stops = list(stops)
+    if len(stops) < 2:
+        raise WRCError("at least two stops are needed")
+    coords, geocode_errors = geocode_unique(stops, region, max_workers, **kwargs)
+    for stop in stops:
+        if stop in geocode_errors:
+            raise geocode_errors[stop]
+
+    def calc_leg(leg):
+        origin, destination = leg
+        if origin == destination:
+            return 0.0, 0.0
+        route = WazeRouteCalculator(coords[origin], coords[destination], region, **kwargs)
+        return route.calc_route_info(real_time=real_time, stop_at_bounds=stop_at_bounds, time_delta=time_delta)
+
+    legs = list(zip(stops, stops[1:]))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda leg: _call(calc_leg, leg), legs))
+    for index, (result, error) in enumerate(results):
+        if error is not None:
+            raise WRCError("leg %d (%s - %s): %s" % (index, legs[index][0], legs[index][1], error))
+    legs = [result for result, error in results]
+    return MultiStopRoute(legs, sum(leg[0] for leg in legs), sum(leg[1] for leg in legs))
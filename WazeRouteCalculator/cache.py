@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Cache backends for geocoding and routing results"""
+
+import asyncio
+import collections
+import json
+import sqlite3
+import threading
+import time
+import weakref
+
+from .singleflight import AsyncSingleFlight, SingleFlight
+
+
+def geocode_key(address, region):
+    """Build cache key from normalized address and region"""
+
+    return "%s|%s" % (region.upper(), ' '.join(address.lower().split()))
+
+
+class MemoryCache(object):
+    """In-memory LRU cache with per-entry TTL"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value or None"""
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        """Store value, evicting the least recently used entries above maxsize"""
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache(object):
+    """On-disk cache stored in a SQLite database, values are JSON encoded"""
+
+    def __init__(self, path, maxsize=100000, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key):
+        """Return cached value or None"""
+
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value, expires = row
+                if expires is None or expires > now:
+                    with self._conn:
+                        self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+                    self.hits += 1
+                    return json.loads(value)
+                with self._conn:
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        """Store value, evicting the least recently used entries above maxsize"""
+
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires, now)
+            )
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,)
+            )
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class RouteCache(object):
+    """Short lived cache of routing responses.
+
+    Keys are built from the routing query with coordinates rounded to precision
+    digits and time_delta bucketed to time_bucket minutes. Concurrent misses of
+    the same key wait for a single upstream request, with get_or_fetch_async
+    too among the coroutines of one event loop.
+    """
+
+    def __init__(self, cache=None, ttl=30, precision=5, time_bucket=5):
+        self.cache = cache if cache is not None else MemoryCache(ttl=ttl)
+        self.ttl = ttl
+        self.precision = precision
+        self.time_bucket = time_bucket
+        self._flight = SingleFlight()
+        self._async_flights = weakref.WeakKeyDictionary()  # event loop: AsyncSingleFlight
+        self._async_lock = threading.Lock()
+
+    def _round_point(self, point):
+        return ' '.join('%s:%.*f' % (axis, self.precision, float(value)) for axis, value in (part.split(':') for part in point.split()))
+
+    def key(self, url, params):
+        """Build cache key from routing server url and query parameters"""
+
+        params = dict(params)
+        params['from'] = self._round_point(params['from'])
+        params['to'] = self._round_point(params['to'])
+        if self.time_bucket:
+            params['at'] = int(params['at'] // self.time_bucket * self.time_bucket)
+        return '%s?%s' % (url, '&'.join('%s=%s' % item for item in sorted(params.items())))
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, route):
+        self.cache.set(key, route, ttl=self.ttl)
+
+    def get_or_fetch(self, key, fetch):
+        """Return cached route or call fetch once for all concurrent callers"""
+
+        route = self.cache.get(key)
+        if route is not None:
+            return route
+
+        def fetch_and_store():
+            route = fetch()
+            self.set(key, route)
+            return route
+
+        return self._flight.do(key, fetch_and_store)
+
+    async def get_or_fetch_async(self, key, fetch):
+        """get_or_fetch for coroutines, fetch returns an awaitable"""
+
+        route = self.cache.get(key)
+        if route is not None:
+            return route
+
+        async def fetch_and_store():
+            route = await fetch()
+            self.set(key, route)
+            return route
+
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            flight = self._async_flights.get(loop)
+            if flight is None:
+                flight = self._async_flights[loop] = AsyncSingleFlight()
+        return await flight.do(key, fetch_and_store)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""Stream route calculations from CSV or JSONL files.
+
+python -m WazeRouteCalculator pairs.csv results.csv --region EU --workers 8 --resume
+"""
+
+import argparse
+import collections
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .WazeRouteCalculator import WazeRouteCalculator, WRCError
+from .batch import _call
+from .cache import MemoryCache
+from .scheduler import PRIORITY_BULK, RequestScheduler
+from .session import WazeSession
+
+OUTPUT_FIELDS = ('row', 'from', 'to', 'route', 'time', 'distance')
+ERROR_FIELDS = ('row', 'from', 'to', 'error')
+
+
+def file_format(path, fmt=None):
+    """csv or jsonl, from fmt or the file extension"""
+
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+
+
+def _parse_line(line):
+    """JSONL line as dict, or WRCError if it is not a JSON object"""
+
+    try:
+        row = json.loads(line)
+    except ValueError as err:
+        return WRCError("invalid JSON: %s" % err)
+    if not isinstance(row, dict):
+        return WRCError("not a JSON object")
+    return row
+
+
+def read_rows(path, fmt=None, skip=0):
+    """Yield input rows as dicts one by one, skipping the first skip rows.
+
+    A JSONL line that is not a JSON object is yielded as WRCError.
+    """
+
+    with open(path, newline='') as f:
+        if file_format(path, fmt) == 'csv':
+            rows = csv.DictReader(f)
+        else:
+            rows = (_parse_line(line) for line in f if line.strip())
+        for number, row in enumerate(rows):
+            if number >= skip:
+                yield row
+
+
+class RowWriter(object):
+    """Append rows to a CSV or JSONL file"""
+
+    def __init__(self, f, fmt, fields):
+        self.f = f
+        self.fmt = fmt
+        self.fields = fields
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(f, fields, extrasaction='ignore')
+            if f.tell() == 0:
+                self.writer.writeheader()
+
+    def write(self, row):
+        if self.fmt == 'csv':
+            self.writer.writerow(row)
+        else:
+            self.f.write(json.dumps(dict((field, row.get(field)) for field in self.fields)) + '\n')
+
+
+def load_checkpoint(path):
+    """Saved progress or None"""
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, state):
+    """Replace the checkpoint atomically"""
+
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def _open_append(path, offset):
+    """Open path for appending after cutting it back to offset"""
+
+    f = open(path, 'a+', newline='')
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def run(input_path, output_path, errors_path=None, checkpoint_path=None, resume=False, fmt=None, from_column='from', to_column='to',
+        region='EU', all_routes=False, npaths=3, real_time=True, stop_at_bounds=False, time_delta=0, max_workers=8, rate=None,
+        checkpoint_every=100, report_every=10, progress=None, **kwargs):
+    """Route every row of input_path and write results in input order to output_path.
+
+    At most max_workers * 4 rows are in memory. Failed rows go to errors_path
+    with their error message, any error of a row only fails that row. Progress is checkpointed every
+    checkpoint_every rows, with resume the run continues from the last
+    checkpoint. progress is called with the stats every report_every seconds.
+    Other keyword arguments go to WazeRouteCalculator.
+    """
+
+    out_fmt = file_format(output_path, fmt)
+    errors_path = errors_path or output_path + '.errors'
+    checkpoint_path = checkpoint_path or output_path + '.checkpoint'
+    state = (load_checkpoint(checkpoint_path) if resume else None) or {"rows": 0, "output_offset": 0, "errors_offset": 0, "failed": 0}
+
+    own_session = kwargs.get('session') is None
+    session = kwargs.pop('session', None) or WazeSession(pool_size=max_workers)
+    kwargs.setdefault('geocode_cache', MemoryCache(maxsize=10000))
+    kwargs.setdefault('priority', PRIORITY_BULK)
+    if rate:
+        kwargs.setdefault('scheduler', RequestScheduler(rate))
+
+    def route_row(row):
+        if isinstance(row, WRCError):
+            raise row
+        if not row.get(from_column) or not row.get(to_column):
+            raise WRCError("missing %s or %s" % (from_column, to_column))
+        route = WazeRouteCalculator(row[from_column], row[to_column], region, lazy=True, session=session, **kwargs)
+        try:
+            if all_routes:
+                return route.calc_all_routes_info(npaths, real_time, stop_at_bounds, time_delta)
+            return route.calc_route_info(real_time, stop_at_bounds, time_delta)
+        except (WRCError, requests.RequestException):
+            raise
+        except Exception as err:
+            # one unexpected answer must not stop a long run, the row goes to the errors file
+            raise WRCError("%s: %s" % (type(err).__name__, err))
+
+    start = time.monotonic()
+    stats = {"rows": state["rows"], "failed": state["failed"], "processed": 0}
+    last_report = [start]
+
+    def report(force=False):
+        now = time.monotonic()
+        if progress is not None and (force or now - last_report[0] >= report_every):
+            last_report[0] = now
+            elapsed = now - start
+            progress(dict(stats, seconds=elapsed, rows_per_second=stats["processed"] / elapsed if elapsed else 0.0))
+
+    output = _open_append(output_path, state["output_offset"])
+    errors = _open_append(errors_path, state["errors_offset"])
+    try:
+        results = RowWriter(output, out_fmt, OUTPUT_FIELDS)
+        failures = RowWriter(errors, out_fmt, ERROR_FIELDS)
+
+        def checkpoint():
+            output.flush()
+            errors.flush()
+            save_checkpoint(checkpoint_path, {"rows": stats["rows"], "output_offset": output.tell(), "errors_offset": errors.tell(), "failed": stats["failed"]})
+
+        def write(number, row, future):
+            result, error = future.result()
+            if isinstance(row, dict):
+                base = {"row": number, "from": row.get(from_column), "to": row.get(to_column)}
+            else:
+                base = {"row": number, "from": None, "to": None}
+            if error is not None:
+                failures.write(dict(base, error=str(error)))
+                stats["failed"] += 1
+            elif all_routes:
+                for name, (route_time, route_distance) in result.items():
+                    results.write(dict(base, route=name, time=route_time, distance=route_distance))
+            else:
+                results.write(dict(base, time=result[0], distance=result[1]))
+            stats["rows"] += 1
+            stats["processed"] += 1
+            if stats["processed"] % checkpoint_every == 0:
+                checkpoint()
+            report()
+
+        window = max_workers * 4
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for number, row in enumerate(read_rows(input_path, fmt, state["rows"]), state["rows"]):
+                pending.append((number, row, executor.submit(_call, route_row, row)))
+                while len(pending) >= window or (pending and pending[0][2].done()):
+                    write(*pending.popleft())
+            while pending:
+                write(*pending.popleft())
+        checkpoint()
+    finally:
+        output.close()
+        errors.close()
+        if own_session:
+            session.close()
+    report(force=True)
+    elapsed = time.monotonic() - start
+    return dict(stats, seconds=elapsed, rows_per_second=stats["processed"] / elapsed if elapsed else 0.0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='waze-route-calculator', description=__doc__.splitlines()[0])
+    parser.add_argument('input', help="CSV or JSONL file with from and to columns")
+    parser.add_argument('output', help="CSV or JSONL result file")
+    parser.add_argument('--errors', help="failed rows, default OUTPUT.errors")
+    parser.add_argument('--checkpoint', help="checkpoint file, default OUTPUT.checkpoint")
+    parser.add_argument('--resume', action='store_true', help="continue from the checkpoint")
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help="file format, default from the extension")
+    parser.add_argument('--from-column', default='from')
+    parser.add_argument('--to-column', default='to')
+    parser.add_argument('--region', default='EU')
+    parser.add_argument('--vehicle-type', default='')
+    parser.add_argument('--avoid-toll-roads', action='store_true')
+    parser.add_argument('--avoid-subscription-roads', action='store_true')
+    parser.add_argument('--avoid-ferries', action='store_true')
+    parser.add_argument('--all-routes', action='store_true', help="write every route of calc_all_routes_info")
+    parser.add_argument('--npaths', type=int, default=3)
+    parser.add_argument('--no-real-time', action='store_true')
+    parser.add_argument('--stop-at-bounds', action='store_true')
+    parser.add_argument('--time-delta', type=int, default=0, help="minutes from now")
+    parser.add_argument('--workers', type=int, default=8, help="concurrent requests")
+    parser.add_argument('--rate', type=float, help="requests per second limit")
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--checkpoint-every', type=int, default=100, help="rows")
+    parser.add_argument('--report-every', type=float, default=10, help="seconds")
+    args = parser.parse_args(argv)
+
+    def progress(stats):
+        sys.stderr.write("%(rows)d rows, %(failed)d failed, %(rows_per_second).1f rows/s\n" % stats)
+
+    session = WazeSession(pool_size=args.workers, retries=args.retries)
+    try:
+        run(args.input, args.output, args.errors, args.checkpoint, args.resume, args.format, args.from_column, args.to_column,
+            args.region, args.all_routes, args.npaths, not args.no_real_time, args.stop_at_bounds, args.time_delta, args.workers, args.rate,
+            args.checkpoint_every, args.report_every, progress, session=session, vehicle_type=args.vehicle_type,
+            avoid_toll_roads=args.avoid_toll_roads, avoid_subscription_roads=args.avoid_subscription_roads, avoid_ferries=args.avoid_ferries)
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
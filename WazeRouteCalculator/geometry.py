@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Route geometry, polyline encoding and simplification"""
+
+import math
+from array import array
+
+KM_PER_DEGREE = 111.32  # km per degree of latitude
+
+
+def encode_polyline(points, precision=5):
+    """Encode (lat, lon) points as a Google polyline string"""
+
+    factor = 10 ** precision
+    chunks = []
+    last_lat = last_lon = 0
+    for lat, lon in points:
+        lat = int(round(lat * factor))
+        lon = int(round(lon * factor))
+        for delta in (lat - last_lat, lon - last_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        last_lat, last_lon = lat, lon
+    return ''.join(chunks)
+
+
+def decode_polyline(polyline, precision=5):
+    """Decode a Google polyline string to a list of (lat, lon) points"""
+
+    factor = float(10 ** precision)
+    points = []
+    index = 0
+    lat = lon = 0
+    values = []
+    while index < len(polyline):
+        shift = result = 0
+        while True:
+            byte = ord(polyline[index]) - 63
+            index += 1
+            result |= (byte & 0x1f) << shift
+            shift += 5
+            if byte < 0x20:
+                break
+        values.append(~(result >> 1) if result & 1 else result >> 1)
+        if len(values) == 2:
+            lat += values[0]
+            lon += values[1]
+            points.append((lat / factor, lon / factor))
+            values = []
+    return points
+
+
+def simplify_indices(x, y, tolerance):
+    """Indices of the points kept by Douglas-Peucker simplification with tolerance in coordinate units"""
+
+    count = len(x)
+    if count < 3:
+        return list(range(count))
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        norm = math.hypot(dx, dy)
+        farthest = None
+        max_distance = tolerance
+        for index in range(first + 1, last):
+            if norm:
+                distance = abs(dy * (x[index] - x[first]) - dx * (y[index] - y[first])) / norm
+            else:
+                distance = math.hypot(x[index] - x[first], y[index] - y[first])
+            if distance > max_distance:
+                farthest, max_distance = index, distance
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [index for index in range(count) if keep[index]]
+
+
+class Geometry(object):
+    """Route shape as x (lon) and y (lat) array columns"""
+
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    @classmethod
+    def from_points(cls, points):
+        """Build from (lat, lon) points"""
+
+        points = list(points)
+        return cls(array('d', [lon for lat, lon in points]), array('d', [lat for lat, lon in points]))
+
+    @classmethod
+    def from_coords(cls, coords):
+        """Build from the coords list of a routing response"""
+
+        x = array('d')
+        y = array('d')
+        for coord in coords:
+            x.append(coord['x'])
+            y.append(coord['y'])
+        return cls(x, y)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        return zip(self.y, self.x)
+
+    def points(self):
+        """List of (lat, lon) points"""
+
+        return list(self)
+
+    def polyline(self, precision=5):
+        """Google polyline of the shape"""
+
+        return encode_polyline(self, precision)
+
+    def simplify(self, tolerance):
+        """New Geometry simplified with Douglas-Peucker, tolerance in degrees"""
+
+        x, y = self.x, self.y
+        indices = simplify_indices(x, y, tolerance)
+        return Geometry(array('d', [x[index] for index in indices]), array('d', [y[index] for index in indices]))
+
+    def __repr__(self):
+        return "<Geometry %d points>" % len(self)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Instrumentation hooks for timing calculator phases"""
+
+import threading
+
+try:
+    import prometheus_client
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+from .WazeRouteCalculator import WRCError
+
+
+class Hooks(object):
+    """Base class for instrumentation hooks, override the events you need.
+
+    Phases are geocode and routing (whole call), geocode_decode and
+    routing_decode (JSON decoding) and add_up (_add_up_route).
+    Endpoints are geocode and routing.
+    """
+
+    def on_phase(self, phase, duration):
+        """Called with the duration of a phase in seconds"""
+
+    def on_request(self, endpoint, duration, status, size, retries):
+        """Called after every HTTP request with status code, response size in bytes and retry count.
+
+        A request that raised has the exception class name as status and size 0.
+        """
+
+    def on_segments(self, count):
+        """Called with the number of segments added up by _add_up_route"""
+
+
+class StatsCollector(Hooks):
+    """In-process collector of counts and durations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+            self.requests = {}
+            self.segments = 0
+
+    def _add(self, stats, value):
+        stats["count"] += 1
+        stats["total"] += value
+        stats["min"] = value if stats["min"] is None else min(stats["min"], value)
+        stats["max"] = value if stats["max"] is None else max(stats["max"], value)
+
+    def on_phase(self, phase, duration):
+        with self._lock:
+            stats = self.phases.setdefault(phase, {"count": 0, "total": 0.0, "min": None, "max": None})
+            self._add(stats, duration)
+
+    def on_request(self, endpoint, duration, status, size, retries):
+        with self._lock:
+            stats = self.requests.setdefault(endpoint, {"count": 0, "total": 0.0, "min": None, "max": None, "bytes": 0, "retries": 0, "status": {}})
+            self._add(stats, duration)
+            stats["bytes"] += size
+            stats["retries"] += retries
+            stats["status"][status] = stats["status"].get(status, 0) + 1
+
+    def on_segments(self, count):
+        with self._lock:
+            self.segments += count
+
+    def summary(self):
+        """Copy of the collected stats with mean durations"""
+
+        with self._lock:
+            summary = {"phases": {}, "requests": {}, "segments": self.segments}
+            for name, source in (("phases", self.phases), ("requests", self.requests)):
+                for key, stats in source.items():
+                    summary[name][key] = dict(stats, mean=stats["total"] / stats["count"])
+                    if "status" in stats:
+                        summary[name][key]["status"] = dict(stats["status"])
+            return summary
+
+
+class PrometheusHooks(Hooks):
+    """Export phase durations, requests, response sizes, retries and segment counts with prometheus_client"""
+
+    def __init__(self, namespace='waze', registry=None):
+        if prometheus_client is None:
+            raise WRCError("prometheus_client is required for PrometheusHooks")
+        kwargs = {"namespace": namespace}
+        if registry is not None:
+            kwargs["registry"] = registry
+        self.phase_seconds = prometheus_client.Histogram('phase_seconds', 'Duration of calculator phases', ['phase'], **kwargs)
+        self.request_seconds = prometheus_client.Histogram('request_seconds', 'Duration of HTTP requests', ['endpoint'], **kwargs)
+        self.requests_total = prometheus_client.Counter('requests_total', 'HTTP requests', ['endpoint', 'status'], **kwargs)
+        self.response_bytes = prometheus_client.Histogram(
+            'response_bytes', 'Size of HTTP responses', ['endpoint'],
+            buckets=(1e3, 1e4, 1e5, 1e6, 1e7, float('inf')), **kwargs
+        )
+        self.retries_total = prometheus_client.Counter('retries_total', 'Retried HTTP requests', ['endpoint'], **kwargs)
+        self.segments = prometheus_client.Histogram(
+            'route_segments', 'Segments added up per route',
+            buckets=(10, 100, 1000, 10000, 100000, float('inf')), **kwargs
+        )
+
+    def on_phase(self, phase, duration):
+        self.phase_seconds.labels(phase).observe(duration)
+
+    def on_request(self, endpoint, duration, status, size, retries):
+        self.request_seconds.labels(endpoint).observe(duration)
+        self.requests_total.labels(endpoint, str(status)).inc()
+        self.response_bytes.labels(endpoint).observe(size)
+        if retries:
+            self.retries_total.labels(endpoint).inc(retries)
+
+    def on_segments(self, count):
+        self.segments.observe(count)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Bulk input normalization"""
+
+import collections
+from array import array
+
+from .WazeRouteCalculator import WazeRouteCalculator
+
+
+NormalizedInputs = collections.namedtuple('NormalizedInputs', 'lat lon addresses address_index')
+
+
+def normalize_inputs(values, pattern=None):
+    """Classify and parse a column of addresses and coordinate strings in one pass.
+
+    Returns NormalizedInputs: lat and lon are array('d') columns with NaN on
+    address rows, addresses are the distinct addresses in order of first
+    appearance and address_index maps every row to its address, -1 on
+    coordinate rows.
+    """
+
+    match = (pattern or WazeRouteCalculator.COORD_MATCH).match
+    nan = float('nan')
+    lat = array('d')
+    lon = array('d')
+    address_index = array('q')
+    addresses = []
+    positions = {}
+    for value in values:
+        if match(value) is not None:
+            row_lat, row_lon = value.split(',')
+            lat.append(float(row_lat))
+            lon.append(float(row_lon))
+            address_index.append(-1)
+            continue
+        position = positions.get(value)
+        if position is None:
+            position = positions[value] = len(addresses)
+            addresses.append(value)
+        lat.append(nan)
+        lon.append(nan)
+        address_index.append(position)
+    return NormalizedInputs(lat, lon, addresses, address_index)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Reachability polygons around an origin"""
+
+import collections
+import math
+
+from .WazeRouteCalculator import WazeRouteCalculator, WRCError
+from .batch import calc_route_matrix, pair_key
+from .geometry import KM_PER_DEGREE
+from .scheduler import PRIORITY_BULK
+
+
+Isochrone = collections.namedtuple('Isochrone', 'origin polygons calls')
+
+
+def destination_point(lat, lon, bearing, distance):
+    """Point distance km from lat, lon towards bearing (degrees), equirectangular approximation"""
+
+    angle = math.radians(bearing)
+    return (
+        lat + distance / KM_PER_DEGREE * math.cos(angle),
+        lon + distance / (KM_PER_DEGREE * math.cos(math.radians(lat))) * math.sin(angle),
+    )
+
+
+def _bracket(samples, threshold):
+    """(lo, hi) distances around threshold from sorted (distance, minutes) samples of a ray"""
+
+    lo = (0.0, 0.0)
+    for distance, minutes in samples:
+        if minutes <= threshold:
+            lo = (distance, minutes)
+    for distance, minutes in samples:
+        if distance > lo[0] and minutes > threshold:
+            return lo, (distance, minutes)
+    return lo, None
+
+
+def calc_isochrone(origin, thresholds, region='EU', rays=16, max_speed=90, samples=3, refine=4, real_time=True, time_delta=0, max_workers=8, pair_cache=None, **kwargs):
+    """Polygons of the area reachable from origin within each threshold (minutes).
+
+    Every one of rays bearings is sampled at samples distances up to
+    max_speed (km/h) times the largest threshold, then the distance where
+    the travel time crosses each threshold is bisected refine times. Only
+    the rays and thresholds still open are routed in each round, concurrently
+    with calc_route_matrix. Failed routes count as unreachable. With
+    pair_cache results are reused between runs.
+    Returns Isochrone with the origin coords, polygons as {threshold: [(lat, lon), ...]}
+    closed rings in bearing order and calls, the number of routing requests sent.
+    """
+
+    thresholds = sorted(thresholds)
+    if not thresholds or thresholds[0] <= 0:
+        raise WRCError("thresholds must be positive")
+    kwargs.setdefault('priority', PRIORITY_BULK)
+    origin_coords = WazeRouteCalculator(None, None, region, lazy=True, **kwargs).resolve(origin)
+    lat, lon = float(origin_coords['lat']), float(origin_coords['lon'])
+    origin_key = "%.6f,%.6f" % (lat, lon)
+    bearings = [360.0 * ray / rays for ray in range(rays)]
+    minutes = dict((ray, {}) for ray in range(rays))
+    calls = [0]
+
+    def point_key(ray, distance):
+        return "%.6f,%.6f" % destination_point(lat, lon, bearings[ray], distance)
+
+    def route(points):
+        """Fill in travel minutes of (ray, distance) points, inf where there is no route"""
+
+        todo = {}
+        for ray, distance in points:
+            if distance in minutes[ray]:
+                continue
+            key = point_key(ray, distance)
+            cached = pair_cache.get(pair_key(origin_key, key, region, real_time, False, time_delta, **kwargs)) if pair_cache is not None else None
+            if cached is not None:
+                minutes[ray][distance] = cached[0]
+            else:
+                todo.setdefault(key, []).append((ray, distance))
+        if not todo:
+            return
+        keys = list(todo)
+        calls[0] += len(keys)
+        matrix = calc_route_matrix([origin_key], keys, region, real_time, False, time_delta, max_workers, **kwargs)
+        for key, time, distance in zip(keys, matrix.times[0], matrix.distances[0]):
+            if time is not None and pair_cache is not None:
+                pair_cache.set(pair_key(origin_key, key, region, real_time, False, time_delta, **kwargs), [time, distance])
+            for ray, ray_distance in todo[key]:
+                minutes[ray][ray_distance] = float('inf') if time is None else time
+
+    max_radius = max_speed * thresholds[-1] / 60.0
+    route([(ray, max_radius * (step + 1) / samples) for ray in range(rays) for step in range(samples)])
+    for _ in range(refine):
+        points = set()
+        for ray in range(rays):
+            ray_samples = sorted(minutes[ray].items())
+            for threshold in thresholds:
+                lo, hi = _bracket(ray_samples, threshold)
+                if hi is not None:
+                    points.add((ray, (lo[0] + hi[0]) / 2.0))
+        if not points:
+            break
+        route(sorted(points))
+
+    polygons = {}
+    for threshold in thresholds:
+        ring = []
+        for ray in range(rays):
+            lo, hi = _bracket(sorted(minutes[ray].items()), threshold)
+            distance = lo[0]
+            if hi is not None and not math.isinf(hi[1]) and hi[1] > lo[1]:
+                distance += (hi[0] - lo[0]) * (threshold - lo[1]) / (hi[1] - lo[1])
+            ring.append(destination_point(lat, lon, bearings[ray], distance))
+        polygons[threshold] = ring + ring[:1]
+    return Isochrone({"lat": lat, "lon": lon, "bounds": origin_coords.get('bounds', {})}, polygons, calls[0])
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Stop order optimization"""
+
+import collections
+
+from .WazeRouteCalculator import WRCError
+from .batch import calc_route_matrix
+
+
+StopOrder = collections.namedtuple('StopOrder', 'order stops time distance')
+
+_EPSILON = 1e-9
+
+
+def _nearest_neighbour(cost, fixed_end):
+    """Greedy path from stop 0, ending at fixed_end if given"""
+
+    unvisited = set(range(len(cost))) - set([0])
+    if fixed_end is not None:
+        unvisited.discard(fixed_end)
+    path = [0]
+    while unvisited:
+        last = path[-1]
+        nearest = min(unvisited, key=lambda stop: (cost[last][stop], stop))
+        path.append(nearest)
+        unvisited.remove(nearest)
+    if fixed_end is not None:
+        path.append(fixed_end)
+    return path
+
+
+def _two_opt(path, cost, last):
+    """Reverse path[i:j + 1] for 1 <= i < j <= last while it improves, works on asymmetric costs"""
+
+    improved = False
+    found = True
+    while found:
+        found = False
+        forward = [0.0]
+        backward = [0.0]
+        for a, b in zip(path, path[1:]):
+            forward.append(forward[-1] + cost[a][b])
+            backward.append(backward[-1] + cost[b][a])
+        for i in range(1, last):
+            for j in range(i + 1, last + 1):
+                old = cost[path[i - 1]][path[i]] + forward[j] - forward[i]
+                new = cost[path[i - 1]][path[j]] + backward[j] - backward[i]
+                if j + 1 < len(path):
+                    old += cost[path[j]][path[j + 1]]
+                    new += cost[path[i]][path[j + 1]]
+                if new < old - _EPSILON:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    found = improved = True
+                    break
+            if found:
+                break
+    return improved
+
+
+def _or_opt(path, cost, last):
+    """Move chains of 1-3 stops to a better position while it improves"""
+
+    improved = False
+    found = True
+    while found:
+        found = False
+        for length in (1, 2, 3):
+            for i in range(1, last - length + 2):
+                chain = path[i:i + length]
+                before = path[i - 1]
+                after = path[i + length] if i + length < len(path) else None
+                removed = cost[before][chain[0]]
+                if after is not None:
+                    removed += cost[chain[-1]][after] - cost[before][after]
+                rest = path[:i] + path[i + length:]
+                rest_last = last - length
+                for k in range(0, rest_last + 1):
+                    if k == i - 1:
+                        continue
+                    nxt = rest[k + 1] if k + 1 < len(rest) else None
+                    added = cost[rest[k]][chain[0]]
+                    if nxt is not None:
+                        added += cost[chain[-1]][nxt] - cost[rest[k]][nxt]
+                    if added < removed - _EPSILON:
+                        path[:] = rest[:k + 1] + chain + rest[k + 1:]
+                        found = improved = True
+                        break
+                if found:
+                    break
+            if found:
+                break
+    return improved
+
+
+def solve_order(cost, return_to_start=False):
+    """Order stops starting at stop 0 with nearest neighbour, then 2-opt and Or-opt.
+
+    cost is a square matrix, returns the visiting order as list of indices.
+    With return_to_start the route goes back to stop 0 at the end.
+    """
+
+    size = len(cost)
+    if size < 3:
+        return list(range(size))
+    if return_to_start:
+        cost = [list(row) + [row[0]] for row in cost]
+        cost.append(list(cost[0]))
+    path = _nearest_neighbour(cost, size if return_to_start else None)
+    last = len(path) - 2 if return_to_start else len(path) - 1
+    while _two_opt(path, cost, last) | _or_opt(path, cost, last):
+        pass
+    return path[:size]
+
+
+def optimize_stop_order(stops, region='EU', return_to_start=False, real_time=True, stop_at_bounds=False, time_delta=0, max_workers=8, pair_cache=None, **kwargs):
+    """Find a short visiting order of stops, starting at the first one.
+
+    The travel time matrix is built with calc_route_matrix, pairs found in
+    pair_cache are not requested again. Returns StopOrder with the order
+    (indices into stops), the reordered stops and the total time (minutes)
+    and distance (km) of the route.
+    """
+
+    stops = list(stops)
+    if len(set(stops)) != len(stops):
+        raise WRCError("stops must be distinct")
+    matrix = calc_route_matrix(stops, stops, region, real_time, stop_at_bounds, time_delta, max_workers, pair_cache, **kwargs)
+    inf = float('inf')
+    cost = [[inf if time is None else time for time in row] for row in matrix.times]
+    order = solve_order(cost, return_to_start)
+    path = order + [0] if return_to_start else order
+    legs = list(zip(path, path[1:]))
+    for origin, destination in legs:
+        if matrix.times[origin][destination] is None:
+            raise WRCError("no route from %s to %s: %s" % (stops[origin], stops[destination], matrix.errors[(origin, destination)]))
+    time = sum(matrix.times[origin][destination] for origin, destination in legs)
+    distance = sum(matrix.distances[origin][destination] for origin, destination in legs)
+    return StopOrder(order, [stops[index] for index in order], time, distance)
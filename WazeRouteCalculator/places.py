@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Local spatial index of geocoded places"""
+
+import json
+import math
+import os
+import threading
+
+
+def bounds_box(bounds):
+    """(left, right, bottom, top) of a bounds dict, missing sides are 0 like in the segment checks"""
+
+    bounds = bounds or {}
+    return (bounds.get('left', 0), bounds.get('right', 0), bounds.get('bottom', 0), bounds.get('top', 0))
+
+
+def inside_bounds(x, y, start_box, end_box):
+    """stop_at_bounds test of a segment point against the start and end boxes"""
+
+    return (start_box[0] < x < start_box[1] or end_box[0] < x < end_box[1]) and (start_box[2] < y < start_box[3] or end_box[2] < y < end_box[3])
+
+
+class PlaceIndex(object):
+    """Grid index of geocoded places and their bounds.
+
+    Places are registered in every cell_size degree cell their bounds cover,
+    so raw coordinates can be mapped to a known place without a network call.
+    Pass it as place_index to the calculator to fill it from geocoding and
+    to add bounds to coordinate inputs. save() and load() keep it on disk.
+    """
+
+    MAX_CELLS = 10000  # cells per place, larger bounds are indexed by their center only
+
+    def __init__(self, cell_size=0.1):
+        self.cell_size = cell_size
+        self._lock = threading.Lock()
+        self._places = []
+        self._names = {}
+        self._grid = {}
+
+    def _cell(self, lon, lat):
+        return int(math.floor(lon / self.cell_size)), int(math.floor(lat / self.cell_size))
+
+    def _cells(self, lat, lon, bounds):
+        if not bounds:
+            return [self._cell(lon, lat)]
+        left, bottom = self._cell(bounds['left'], bounds['bottom'])
+        right, top = self._cell(bounds['right'], bounds['top'])
+        if (right - left + 1) * (top - bottom + 1) > self.MAX_CELLS:
+            return [self._cell(lon, lat)]
+        return [(x, y) for x in range(left, right + 1) for y in range(bottom, top + 1)]
+
+    def add(self, name, coords):
+        """Add or replace the place called name with its coords dict"""
+
+        bounds = dict(coords.get('bounds') or {})
+        if bounds and not all(side in bounds for side in ('left', 'right', 'bottom', 'top')):
+            bounds = {}
+        with self._lock:
+            if name in self._names:
+                self._remove(self._names[name])
+            place_id = len(self._places)
+            self._places.append((name, coords['lat'], coords['lon'], bounds))
+            self._names[name] = place_id
+            for cell in self._cells(coords['lat'], coords['lon'], bounds):
+                self._grid.setdefault(cell, []).append(place_id)
+
+    def _remove(self, place_id):
+        name, lat, lon, bounds = self._places[place_id]
+        for cell in self._cells(lat, lon, bounds):
+            self._grid[cell].remove(place_id)
+            if not self._grid[cell]:
+                del self._grid[cell]
+        self._places[place_id] = None
+
+    def get(self, name):
+        """Coords dict of the place called name or None"""
+
+        with self._lock:
+            place_id = self._names.get(name)
+            if place_id is None:
+                return None
+            name, lat, lon, bounds = self._places[place_id]
+            return {"lat": lat, "lon": lon, "bounds": dict(bounds)}
+
+    def lookup(self, lat, lon):
+        """(name, coords) of the smallest known place whose bounds contain the point, or None"""
+
+        best = None
+        with self._lock:
+            for place_id in self._grid.get(self._cell(lon, lat), ()):
+                name, place_lat, place_lon, bounds = self._places[place_id]
+                if not bounds or not (bounds['left'] <= lon <= bounds['right'] and bounds['bottom'] <= lat <= bounds['top']):
+                    continue
+                area = (bounds['right'] - bounds['left']) * (bounds['top'] - bounds['bottom'])
+                if best is None or area < best[0]:
+                    best = (area, name, {"lat": place_lat, "lon": place_lon, "bounds": dict(bounds)})
+        return best[1:] if best is not None else None
+
+    def snap(self, coords):
+        """coords with the bounds of the known place containing it, unchanged if there is none"""
+
+        found = self.lookup(coords['lat'], coords['lon'])
+        if found is None:
+            return coords
+        return dict(coords, bounds=found[1]['bounds'])
+
+    def __len__(self):
+        return len(self._names)
+
+    def save(self, path):
+        """Write the places to path as JSON"""
+
+        with self._lock:
+            places = [place for place in self._places if place is not None]
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({"cell_size": self.cell_size, "places": places}, f, separators=(',', ':'))
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Index saved with save(), an empty one if path does not exist"""
+
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            data = json.load(f)
+        index = cls(data["cell_size"])
+        for name, lat, lon, bounds in data["places"]:
+            index.add(name, {"lat": lat, "lon": lon, "bounds": bounds})
+        return index
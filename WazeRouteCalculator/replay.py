@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Record and replay of Waze HTTP exchanges for offline runs"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from urllib.parse import urlencode, urlsplit
+
+import requests
+
+from .WazeRouteCalculator import WazeRouteCalculator, WRCError
+
+MAGIC = b'WRCREC1\n'
+_FOOTER = struct.Struct('<Q')
+
+
+def request_key(url, params=None):
+    """Normalized key of a request: url path and sorted query parameters, the host is ignored"""
+
+    items = sorted((str(name), str(value)) for name, value in (params or {}).items())
+    return '%s?%s' % (urlsplit(url).path, urlencode(items))
+
+
+def _read_index(data):
+    """(index, index offset) of an archive"""
+
+    if len(data) < 2 * len(MAGIC) + _FOOTER.size or data[:len(MAGIC)] != MAGIC or data[-len(MAGIC):] != MAGIC:
+        raise WRCError("not a recording archive")
+    end = len(data) - len(MAGIC) - _FOOTER.size
+    offset = _FOOTER.unpack(data[end:end + _FOOTER.size])[0]
+    return json.loads(zlib.decompress(data[offset:end]).decode('utf-8')), offset
+
+
+class RecordingSession(object):
+    """Session that sends requests and writes every exchange to a compressed archive at path.
+
+    Requests go through session (WazeSession) if given, otherwise requests.get.
+    With append new exchanges are added to an existing archive.
+    Call close() to write the index.
+    """
+
+    def __init__(self, path, session=None, append=False, timeout=WazeRouteCalculator.HTTP_TIMEOUT):
+        self.path = path
+        self.session = session
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.index = {}
+        if append and os.path.exists(path):
+            self._file = open(path, 'r+b')
+            self.index, offset = _read_index(self._file.read())
+            self._file.seek(offset)
+            self._file.truncate()
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(MAGIC)
+
+    def get(self, url, params=None, headers=None, alternates=(), acquire=None):
+        if self.session is None:
+            if acquire is not None:
+                acquire()
+            response = requests.get(url, params=params, headers=headers, timeout=self.timeout)
+        else:
+            options = {}
+            if alternates:
+                options['alternates'] = alternates
+            if acquire is not None:
+                options['acquire'] = acquire
+            response = self.session.get(url, params=params, headers=headers, **options)
+        self.record(request_key(url, params), response.status_code, response.content)
+        return response
+
+    def record(self, key, status_code, content):
+        """Add an exchange, a later one with the same key replaces it"""
+
+        body = zlib.compress(content)
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(body)
+            self.index[key] = [offset, len(body), status_code]
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            offset = self._file.tell()
+            self._file.write(zlib.compress(json.dumps(self.index).encode('utf-8')))
+            self._file.write(_FOOTER.pack(offset))
+            self._file.write(MAGIC)
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ReplaySession(object):
+    """Session answering from an archive written by RecordingSession, without network.
+
+    The archive is memory mapped and bodies are decompressed on lookup.
+    latency (seconds) is added to every response. Unknown requests raise WRCError.
+    """
+
+    def __init__(self, path, latency=0.0):
+        self.path = path
+        self.latency = latency
+        self._file = open(path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index, _ = _read_index(self._data)
+
+    def get(self, url, params=None, headers=None, alternates=(), acquire=None):
+        if acquire is not None:
+            acquire()
+        key = request_key(url, params)
+        entry = self.index.get(key)
+        if entry is None:
+            raise WRCError("no recording for %s" % key)
+        offset, length, status_code = entry
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = zlib.decompress(self._data[offset:offset + length])
+        response.url = url
+        response.encoding = 'utf-8'
+        if self.latency:
+            time.sleep(self.latency)
+        return response
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Compact route result"""
+
+import json
+import math
+from array import array
+
+from .geometry import Geometry
+from .places import bounds_box, inside_bounds
+
+
+class Route(object):
+    """Routing result with the segments stored in array columns.
+
+    length (m), cross_time and cross_time_without_real_time (s) and the x/y
+    of the segment path are kept, missing values are NaN. The route shape
+    from the response coords is kept as array columns too.
+    """
+
+    __slots__ = ('route_type', 'short_route_name', 'length', 'cross_time', 'cross_time_without_real_time', 'x', 'y', '_raw', '_geometry')
+
+    def __init__(self, route_type, short_route_name, length, cross_time, cross_time_without_real_time, x, y, raw=None, geometry=None):
+        self.route_type = route_type
+        self.short_route_name = short_route_name
+        self.length = length
+        self.cross_time = cross_time
+        self.cross_time_without_real_time = cross_time_without_real_time
+        self.x = x
+        self.y = y
+        self._raw = raw
+        self._geometry = geometry
+
+    @classmethod
+    def from_dict(cls, route, keep_raw=False):
+        """Build from a route dict returned by get_route, keep_raw keeps the full response as compact JSON"""
+
+        length = array('d')
+        cross_time = array('d')
+        cross_time_without_real_time = array('d')
+        x = array('d')
+        y = array('d')
+        nan = float('nan')
+        for segment in route['results' if 'results' in route else 'result']:
+            if 'crossTime' in segment:
+                cross_time.append(segment['crossTime'])
+                cross_time_without_real_time.append(segment.get('crossTimeWithoutRealTime', nan))
+            else:
+                cross_time.append(segment.get('cross_time', nan))
+                cross_time_without_real_time.append(segment.get('cross_time_without_real_time', nan))
+            length.append(segment['length'])
+            path = segment.get('path')
+            x.append(path['x'] if path else nan)
+            y.append(path['y'] if path else nan)
+        raw = json.dumps(route, separators=(',', ':')) if keep_raw else None
+        geometry = Geometry.from_coords(route['coords']) if route.get('coords') else None
+        return cls(route.get('routeType', []), route.get('shortRouteName', 'unkown'), length, cross_time, cross_time_without_real_time, x, y, raw, geometry)
+
+    @property
+    def key(self):
+        """Route name as used by calc_all_routes_info"""
+
+        return "%s-%s" % (''.join(self.route_type[:1]), self.short_route_name)
+
+    @property
+    def geometry(self):
+        """Route shape as Geometry, from the response coords or else the segment paths"""
+
+        if self._geometry is None:
+            points = [(y, x) for x, y in zip(self.x, self.y) if not math.isnan(x)]
+            self._geometry = Geometry.from_points(points)
+        return self._geometry
+
+    def __len__(self):
+        return len(self.length)
+
+    def segment(self, index):
+        """Segment as dict with the v1 response keys"""
+
+        segment = {"length": self.length[index], "crossTime": self.cross_time[index]}
+        if not math.isnan(self.cross_time_without_real_time[index]):
+            segment["crossTimeWithoutRealTime"] = self.cross_time_without_real_time[index]
+        if not math.isnan(self.x[index]):
+            segment["path"] = {"x": self.x[index], "y": self.y[index]}
+        return segment
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.segment(index)
+
+    def total(self, real_time=True, start_bounds=None, end_bounds=None):
+        """Route time (minutes) and distance (km), skipping segments inside start or end bounds if given"""
+
+        times = self.cross_time if real_time else self.cross_time_without_real_time
+        trim = bool(start_bounds or end_bounds)
+        start_box = bounds_box(start_bounds)
+        end_box = bounds_box(end_bounds)
+
+        time = 0
+        distance = 0
+        for index in range(len(self.length)):
+            if trim and inside_bounds(self.x[index], self.y[index], start_box, end_box):
+                continue
+            if math.isnan(times[index]):
+                raise KeyError('crossTime' if real_time else 'crossTimeWithoutRealTime')
+            time += times[index]
+            distance += self.length[index]
+        return time / 60.0, distance / 1000.0
+
+    def to_dict(self):
+        """Route as dict, the full response if it was kept otherwise rebuilt from the columns"""
+
+        if self._raw is not None:
+            return json.loads(self._raw)
+        return {"routeType": list(self.route_type), "shortRouteName": self.short_route_name, "results": list(self)}
+
+    def __repr__(self):
+        return "<Route %s %d segments>" % (self.key, len(self))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Client side rate limiting and request scheduling"""
+
+import heapq
+import itertools
+import threading
+import time
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket refilled with rate tokens per second up to burst"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available, return 0 or the seconds to wait until they are"""
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Block until tokens are taken"""
+
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class RequestScheduler(object):
+    """Rate limit requests per endpoint, lower priority value goes first.
+
+    rate and burst apply to every endpoint, endpoint_rates overrides them
+    like {'geocode': (rate, burst)}. Share one scheduler between threads and
+    calculators to limit all of them together.
+    """
+
+    def __init__(self, rate, burst=None, endpoint_rates=None):
+        self.rate = rate
+        self.burst = burst
+        self.endpoint_rates = dict(endpoint_rates or {})
+        self._buckets = {}
+        self._queues = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stats = {}
+
+    def _bucket(self, endpoint):
+        if endpoint not in self._buckets:
+            rate, burst = self.endpoint_rates.get(endpoint, (self.rate, self.burst))
+            self._buckets[endpoint] = TokenBucket(rate, burst)
+        return self._buckets[endpoint]
+
+    def acquire(self, endpoint, priority=PRIORITY_INTERACTIVE):
+        """Block until the request may be sent, return the seconds waited"""
+
+        start = time.monotonic()
+        with self._condition:
+            bucket = self._bucket(endpoint)
+            queue = self._queues.setdefault(endpoint, [])
+            ticket = (priority, next(self._counter))
+            heapq.heappush(queue, ticket)
+            self._condition.notify_all()
+            while True:
+                if queue[0] == ticket:
+                    wait = bucket.try_acquire()
+                    if not wait:
+                        heapq.heappop(queue)
+                        self._condition.notify_all()
+                        break
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+            waited = time.monotonic() - start
+            stats = self._stats.setdefault(priority, {"count": 0, "wait_total": 0.0, "wait_max": 0.0})
+            stats["count"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+        return waited
+
+    def queue_depth(self, endpoint=None):
+        """Number of requests waiting, for one endpoint or all of them"""
+
+        with self._condition:
+            if endpoint is not None:
+                return len(self._queues.get(endpoint, []))
+            return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        """Queue depth per endpoint and wait times per priority"""
+
+        with self._condition:
+            return {
+                "queue_depth": dict((endpoint, len(queue)) for endpoint, queue in self._queues.items()),
+                "priorities": dict((priority, dict(stats)) for priority, stats in self._stats.items()),
+            }
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Shared HTTP transport for Waze requests"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .WazeRouteCalculator import WazeRouteCalculator, _json_loads
+
+
+class WazeSession(object):
+    """Keep-alive HTTP session with per host connection pools, shareable between calculators"""
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=10, timeout=60, retries=0, backoff_factor=0.5, jitter=True, hedge_after=None):
+        self.log = logging.getLogger(__name__)
+        self.log.addHandler(logging.NullHandler())
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.hedge_after = hedge_after
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        hosts = set([WazeRouteCalculator.WAZE_URL])
+        hosts.update(WazeRouteCalculator.ROUTING_SERVERS.values())
+        for url in hosts:
+            self.mount(url, pool_size)
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=pool_size))
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def mount(self, url, pool_size):
+        """Use a dedicated connection pool for the host of url"""
+
+        prefix = '/'.join(url.split('/')[:3]) + '/'
+        self.session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def get(self, url, params=None, headers=None, alternates=(), acquire=None):
+        """GET with timeout, retrying connection errors and server errors with jittered exponential backoff.
+
+        The first retry goes to url again, later ones to the urls of
+        alternates in turn. alternates must be servers that can answer the
+        same request. With hedge_after (seconds) and alternates a duplicate
+        request is sent to the next alternate if there is no answer in time,
+        the first good response wins. acquire is called before every request
+        that goes out, retries and hedges included, e.g. to take a rate
+        limiter token. A 429 answer's Retry-After is waited at least.
+        """
+
+        urls = [url] + [alternate for alternate in alternates if alternate != url]
+        attempt = 0
+        while True:
+            position = max(attempt - 1, 0)
+            target = urls[position % len(urls)]
+            hedge = urls[(position + 1) % len(urls)] if self.hedge_after is not None and len(urls) > 1 else None
+            try:
+                response = self._send(target, hedge, params, headers, acquire)
+                if response.status_code not in self.RETRY_STATUSES or attempt >= self.retries:
+                    response.retries = attempt
+                    return response
+                self.log.debug('HTTP %s from %s, retrying', response.status_code, target)
+                delay = max(self.backoff(attempt), self.retry_after(response))
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt >= self.retries:
+                    err.retries = attempt
+                    raise
+                self.log.debug('%s from %s, retrying', err, target)
+                delay = self.backoff(attempt)
+            time.sleep(delay)
+            attempt += 1
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry attempt + 1"""
+
+        delay = self.backoff_factor * (2 ** attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    @staticmethod
+    def retry_after(response):
+        """Seconds asked for by the Retry-After header of a 429 answer, 0 without one"""
+
+        if response.status_code != 429:
+            return 0
+        try:
+            return max(float(response.headers.get('Retry-After', 0)), 0)
+        except ValueError:
+            return 0
+
+    def _request(self, url, params, headers, acquire, sent=None):
+        try:
+            if acquire is not None:
+                acquire()
+        finally:
+            if sent is not None:
+                sent.set()
+        return self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+
+    def _send(self, url, hedge, params, headers, acquire):
+        if hedge is None:
+            return self._request(url, params, headers, acquire)
+        executor = self._get_executor()
+        sent = threading.Event()
+        primary = executor.submit(self._request, url, params, headers, acquire, sent)
+        # hedge_after counts from the send, not from the time queued for a worker or a token
+        sent.wait()
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            return primary.result()
+        self.log.debug('No answer from %s in %.3fs, sending request to %s', url, self.hedge_after, hedge)
+        secondary = executor.submit(self._request, hedge, params, headers, acquire)
+        pending = [primary, secondary]
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if primary in done and primary.exception() is None and primary.result().status_code not in self.RETRY_STATUSES:
+                return primary.result()
+            # the hedge only wins with a real answer, an error payload waits for the primary
+            if secondary in done and secondary.exception() is None and self.good_answer(secondary.result()):
+                return secondary.result()
+        if primary.exception() is not None and secondary.exception() is None:
+            return secondary.result()
+        return primary.result()
+
+    @staticmethod
+    def good_answer(response):
+        """Successful JSON response without the "error" key that _parse_route fails on"""
+
+        if not response.ok:
+            return False
+        try:
+            answer = _json_loads(response.content)
+        except ValueError:
+            return False
+        return not (isinstance(answer, dict) and 'error' in answer)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                # a primary and a hedge for every pooled connection
+                self._executor = ThreadPoolExecutor(max_workers=2 * self.pool_size)
+            return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
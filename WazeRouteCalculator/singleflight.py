@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Coalescing of concurrent identical requests"""
+
+import asyncio
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run one call per key at a time, concurrent callers of the same key share its result or error"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """Return func(), or wait for the call of the same key already in flight"""
+
+        with self._lock:
+            call = self._pending.get(key)
+            leader = call is None
+            if leader:
+                call = self._pending[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+            call.event.set()
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._pending)}
+
+
+class AsyncSingleFlight(object):
+    """SingleFlight for coroutines running on one event loop"""
+
+    def __init__(self):
+        self._pending = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, func):
+        """Return await func(), or wait for the call of the same key already in flight"""
+
+        future = self._pending.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+        future = self._pending[key] = asyncio.get_running_loop().create_future()
+        self.calls += 1
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except Exception as err:
+            future.set_exception(err)
+            future.exception()  # retrieved, no warning when nobody waited
+            raise
+        finally:
+            del self._pending[key]
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._pending)}
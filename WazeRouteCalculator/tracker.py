@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Remaining time and distance of tracked vehicles"""
+
+import bisect
+import copy
+import math
+import time
+from array import array
+
+from .geometry import KM_PER_DEGREE
+
+
+class RouteTracker(object):
+    """Follow a vehicle along the route of calculator.
+
+    Remaining time and distance come from prefix sums over the segments,
+    get_route is only called again when the position is more than
+    max_deviation km away from the route or refresh_interval seconds passed
+    since the last request. Both re-query from the current position, with a
+    copy of calculator so its start_coords stay as they are. Routes without
+    geometry (summary_only) are only refreshed by time.
+    Positions are matched against the route up to lookahead km ahead of the
+    current segment, so an update does not scan the whole route.
+    """
+
+    WINDOW_MARGIN = 0.5  # km of geometry added on both sides of the lookahead window
+
+    def __init__(self, calculator, real_time=True, refresh_interval=300, max_deviation=0.2, clock=time.monotonic, lookahead=5.0):
+        self.calculator = calculator
+        self._calculator = copy.copy(calculator)
+        self.real_time = real_time
+        self.refresh_interval = refresh_interval
+        self.max_deviation = max_deviation
+        self.lookahead = lookahead
+        self.clock = clock
+        self.refreshes = 0
+        self.refresh()
+
+    def refresh(self, lat=None, lon=None):
+        """Request the route again, from lat, lon if given"""
+
+        if lat is not None:
+            self._calculator.start_coords = {"lat": lat, "lon": lon, "bounds": {}}
+        route = self._calculator.get_routes(npaths=1)[0]
+        route.total(self.real_time)  # KeyError like calc_route_info if times are missing
+        times = route.cross_time if self.real_time else route.cross_time_without_real_time
+        self.time_prefix = array('d', [0.0])
+        self.distance_prefix = array('d', [0.0])
+        for segment_time, length in zip(times, route.length):
+            self.time_prefix.append(self.time_prefix[-1] + segment_time)
+            self.distance_prefix.append(self.distance_prefix[-1] + length)
+        self.route = route
+        self.paths = array('l', [index for index in range(len(route)) if not math.isnan(route.x[index])])
+        geometry = route.geometry
+        # km along the geometry, scaled to the segment lengths so both can be windowed the same way
+        self.geometry_prefix = array('d', [0.0])
+        x = geometry.x
+        y = geometry.y
+        for index in range(1, len(geometry)):
+            scale = math.cos(math.radians(y[index]))
+            self.geometry_prefix.append(self.geometry_prefix[-1] + math.hypot(y[index] - y[index - 1], (x[index] - x[index - 1]) * scale) * KM_PER_DEGREE)
+        self.geometry_scale = self.geometry_prefix[-1] / (self.distance_prefix[-1] / 1000.0) if self.distance_prefix[-1] else 1.0
+        self.index = 0
+        self.refreshed = self.clock()
+        self.refreshes += 1
+
+    @staticmethod
+    def _line_distance(lat, lon, x1, y1, x2, y2):
+        """km from lat, lon to the line between (x1, y1) and (x2, y2)"""
+
+        scale = math.cos(math.radians(lat))
+        dx = (x2 - x1) * scale
+        dy = y2 - y1
+        px = (lon - x1) * scale
+        py = lat - y1
+        length = dx * dx + dy * dy
+        share = min(max((px * dx + py * dy) / length, 0.0), 1.0) if length else 0.0
+        return math.hypot(px - share * dx, py - share * dy) * KM_PER_DEGREE
+
+    def _window(self):
+        """(first, last) positions in paths of the segments from the current one to lookahead km ahead"""
+
+        end = bisect.bisect_right(self.distance_prefix, self.distance_prefix[self.index] + self.lookahead * 1000.0)
+        first = min(bisect.bisect_left(self.paths, self.index), len(self.paths) - 1)
+        last = max(bisect.bisect_left(self.paths, end), first + 1)
+        return first, min(last, len(self.paths))
+
+    def _nearest(self, lat, lon):
+        """(index, km) of the closest segment in the window, or None without segment paths.
+
+        A segment reaches from its path point to the next one, the last one to the end of the route geometry.
+        """
+
+        if not self.paths:
+            return None
+        x = self.route.x
+        y = self.route.y
+        geometry = self.route.geometry
+        first, last = self._window()
+        best = (self.paths[first], float('inf'))
+        for position in range(first, last):
+            index = self.paths[position]
+            if position + 1 < len(self.paths):
+                end_x, end_y = x[self.paths[position + 1]], y[self.paths[position + 1]]
+            else:
+                end_x, end_y = geometry.x[-1], geometry.y[-1]
+            distance = self._line_distance(lat, lon, x[index], y[index], end_x, end_y)
+            if distance <= best[1]:  # on a shared point the later segment wins
+                best = (index, distance)
+        return best
+
+    def _deviation(self, lat, lon, nearest):
+        """km from the route geometry (response coords or else segment paths) around the window"""
+
+        geometry = self.route.geometry
+        if len(geometry) < 2:
+            return nearest[1]
+        x = geometry.x
+        y = geometry.y
+        distance = self.distance_prefix[self.index] / 1000.0
+        start = distance * self.geometry_scale - self.WINDOW_MARGIN
+        end = (distance + self.lookahead) * self.geometry_scale + self.WINDOW_MARGIN
+        first = max(bisect.bisect_left(self.geometry_prefix, start) - 1, 0)
+        last = min(bisect.bisect_right(self.geometry_prefix, end), len(x) - 1)
+        if last <= first:
+            return nearest[1]
+        return min(self._line_distance(lat, lon, x[index], y[index], x[index + 1], y[index + 1]) for index in range(first, last))
+
+    def update(self, lat, lon):
+        """Record a position, return remaining route time (minutes) and distance (km)"""
+
+        if self.clock() - self.refreshed >= self.refresh_interval:
+            self.refresh(lat, lon)
+            return self.remaining()
+        nearest = self._nearest(lat, lon)
+        if nearest is None:
+            return self.remaining()
+        if self._deviation(lat, lon, nearest) > self.max_deviation:
+            self.refresh(lat, lon)
+        else:
+            self.index = nearest[0]
+        return self.remaining()
+
+    def remaining(self):
+        """Remaining route time (minutes) and distance (km) from the current segment"""
+
+        return (
+            (self.time_prefix[-1] - self.time_prefix[self.index]) / 60.0,
+            (self.distance_prefix[-1] - self.distance_prefix[self.index]) / 1000.0,
+        )
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Waze search and routing servers"""
+
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:  # pragma: no cover
+    from http.server import BaseHTTPRequestHandler, HTTPServer as ThreadingHTTPServer
+
+import WazeRouteCalculator
+
+
+def geocode_payload(lat=47.4979, lon=19.0402):
+    """Address search response with one city"""
+
+    bounds = {"bottom": lat - 0.1, "top": lat + 0.1, "left": lon - 0.1, "right": lon + 0.1}
+    return json.dumps([{"city": "Mock", "name": "Mock city", "location": {"lat": lat, "lon": lon}, "bounds": bounds}]).encode('utf-8')
+
+
+def routing_payload(segments=1000, alternatives=None, lat=47.4979, lon=19.0402):
+    """Routing response with geometry and instructions, like returnGeometries=true returns.
+
+    Without alternatives the response has the single route form of nPaths=1.
+    """
+
+    routes = []
+    for alternative in range(alternatives or 1):
+        results = []
+        coords = []
+        for index in range(segments):
+            x = lon + index * 0.0005
+            y = lat + index * 0.0002 + alternative * 0.0001
+            results.append({
+                "path": {"segmentId": index, "nodeId": index + 1, "x": x, "y": y, "direction": True},
+                "street": index % 50,
+                "length": 80 + index % 40,
+                "crossTime": 6 + index % 7,
+                "crossTimeWithoutRealTime": 5 + index % 7,
+                "instruction": {"opcode": "CONTINUE", "arg": 0, "instructionText": ""},
+                "knownDirection": True,
+                "penalty": 0,
+                "roadType": 1,
+            })
+            coords.append({"x": x, "y": y, "z": "NaN"})
+        routes.append({"response": {
+            "results": results,
+            "streetNames": ["Street %d" % index for index in range(50)],
+            "routeType": ["BEST" if alternative == 0 else "ALT"],
+            "shortRouteName": "Route %d" % alternative,
+            "totalRouteTime": sum(result["crossTime"] for result in results),
+        }, "coords": coords})
+    if alternatives is None:
+        return json.dumps(routes[0]).encode('utf-8')
+    return json.dumps({"alternatives": routes}).encode('utf-8')
+
+
+class MockWazeServer(object):
+    """Threaded HTTP server answering SearchServer/mozi and RoutingManager/routingRequest.
+
+    Payloads are synthetic (segments, alternatives) unless recorded ones are
+    given, latency (seconds) is added to every answer.
+    """
+
+    def __init__(self, segments=1000, alternatives=3, latency=0.0, geocode=None, route=None, routes=None, port=0):
+        self.latency = latency
+        self.geocode = geocode if geocode is not None else geocode_payload()
+        self.route = route if route is not None else routing_payload(segments)
+        self.routes = routes if routes is not None else routing_payload(segments, alternatives)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                path, _, query = self.path.partition('?')
+                if path.endswith('SearchServer/mozi'):
+                    body = server.geocode
+                elif path.endswith('RoutingManager/routingRequest'):
+                    body = server.route if parse_qs(query).get('nPaths') == ['1'] else server.routes
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+        self._thread = None
+
+    @classmethod
+    def from_recording(cls, directory, latency=0.0):
+        """Serve geocode.json, route.json (nPaths=1) and routes.json recorded from the real servers"""
+
+        payloads = {}
+        for name in ('geocode', 'route', 'routes'):
+            with open(os.path.join(directory, name + '.json'), 'rb') as f:
+                payloads[name] = f.read()
+        return cls(latency=latency, **payloads)
+
+    def calculator_class(self):
+        """WazeRouteCalculator subclass pointing at this server"""
+
+        url = self.url
+        return type('MockWazeRouteCalculator', (WazeRouteCalculator.WazeRouteCalculator,), {
+            'WAZE_URL': url,
+            'COORD_SERVERS': dict((region, 'SearchServer/mozi') for region in WazeRouteCalculator.WazeRouteCalculator.COORD_SERVERS),
+            'ROUTING_SERVERS': dict((region, url + 'RoutingManager/routingRequest') for region in WazeRouteCalculator.WazeRouteCalculator.ROUTING_SERVERS),
+        })
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
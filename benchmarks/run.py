@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline benchmarks against the local mock Waze server.
+
+python -m benchmarks.run --segments 2000 --alternatives 3 --latency 0.01 --output results.json
+"""
+
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+import WazeRouteCalculator
+from .mock_server import MockWazeServer
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of sorted values"""
+
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+def measure(func, iterations, concurrency=1):
+    """Run func iterations times on concurrency threads, return latency and throughput stats"""
+
+    def timed(_):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, range(iterations)))
+    else:
+        latencies = [timed(i) for i in range(iterations)]
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "throughput": iterations / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def run(segments=1000, alternatives=3, latency=0.0, iterations=50, concurrency=1, recording=None, cases=None, processes=None):
+    """Run benchmark cases, return machine readable results.
+
+    calc_all_routes_info_processes decodes and adds up in a ProcessBackend
+    with processes workers, compare it with calc_all_routes_info at the same concurrency.
+    add_up_route_columns and add_up_route_numpy add up the same Route with the
+    loop and with the opt-in numpy path (VECTORIZE_MIN_SEGMENTS).
+    """
+
+    if recording:
+        server = MockWazeServer.from_recording(recording, latency=latency)
+    else:
+        server = MockWazeServer(segments=segments, alternatives=alternatives, latency=latency)
+    results = {}
+    with server:
+        calculator = server.calculator_class()
+        session = WazeRouteCalculator.WazeSession(pool_size=max(concurrency, 10))
+        route = calculator("Mock start", "Mock end", session=session)
+        backend = WazeRouteCalculator.ProcessBackend(max_workers=processes)
+        route_processes = calculator("Mock start", "Mock end", session=session, backend=backend)
+        results_route = route.get_route(1)
+        columns = WazeRouteCalculator.Route.from_dict(results_route)
+        results_route = results_route['results' if 'results' in results_route else 'result']
+        vectorized = calculator(route.start_coords, route.end_coords, session=session)
+        vectorized.VECTORIZE_MIN_SEGMENTS = 0
+        available = {
+            "geocode": lambda: route.address_to_coords("Mock address"),
+            "calc_route_info": lambda: route.calc_route_info(),
+            "calc_all_routes_info": lambda: route.calc_all_routes_info(npaths=alternatives),
+            "calc_all_routes_info_processes": lambda: route_processes.calc_all_routes_info(npaths=alternatives),
+            "add_up_route": lambda: route._add_up_route(results_route, stop_at_bounds=True),
+            "add_up_route_columns": lambda: route._add_up_route(columns, stop_at_bounds=True),
+        }
+        if numpy is not None:
+            available["add_up_route_numpy"] = lambda: vectorized._add_up_route(columns, stop_at_bounds=True)
+        for name in cases or sorted(available):
+            results[name] = measure(available[name], iterations, concurrency if not name.startswith("add_up_route") else 1)
+        session.close()
+        backend.close()
+    return {
+        "version": WazeRouteCalculator.__version__,
+        "python": platform.python_version(),
+        "params": {
+            "segments": segments,
+            "alternatives": alternatives,
+            "latency": latency,
+            "iterations": iterations,
+            "concurrency": concurrency,
+            "processes": processes,
+            "recording": recording,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=1000, help="segments per route")
+    parser.add_argument('--alternatives', type=int, default=3, help="routes per calc_all_routes_info response")
+    parser.add_argument('--latency', type=float, default=0.0, help="artificial server latency in seconds")
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--processes', type=int, help="ProcessBackend workers, default one per CPU")
+    parser.add_argument('--recording', help="directory with recorded geocode.json, route.json and routes.json")
+    parser.add_argument('--case', action='append', dest='cases', help="run only this case, can be repeated")
+    parser.add_argument('--output', help="write JSON results to file instead of stdout")
+    args = parser.parse_args(argv)
+    results = run(args.segments, args.alternatives, args.latency, args.iterations, args.concurrency, args.recording, args.cases, args.processes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
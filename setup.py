@@ -27,5 +27,14 @@ setup(
     keywords = ['waze', 'route', 'calculator'],
     packages = ['WazeRouteCalculator'],
     install_requires = ['requests'],
+    entry_points = {
+        'console_scripts': ['waze-route-calculator = WazeRouteCalculator.cli:main'],
+    },
+    extras_require = {
+        'async': ['aiohttp'],
+        'numpy': ['numpy'],
+        'orjson': ['orjson'],
+        'prometheus': ['prometheus_client'],
+    },
     long_description = read('readme.md')
 )
@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import WazeRouteCalculator as wrc
+import json
+import math
 import mock
 import requests_mock
 import pytest
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 class TestWRC():
@@ -64,8 +71,18 @@ class TestWRC():
             addr_query = m.get(self.address_req, text=self.address_to_coords_response)
             route = wrc.WazeRouteCalculator(from_address, to_address)
         assert not addr_query.called
-        assert route.start_coords["lat"] == from_address.split(",")[0]
-        assert route.end_coords["lat"] == to_address.split(",")[0]
+        assert route.start_coords == {"lat": 47.497912, "lon": 19.040235, "bounds": {}}
+        assert route.end_coords["lat"] == float(to_address.split(",")[0])
+
+    def test_place_index_snaps_coords(self):
+        index = wrc.PlaceIndex()
+        with requests_mock.mock() as m:
+            addr_query = m.get(self.address_req, text=self.address_to_coords_response)
+            wrc.WazeRouteCalculator("From address", "47.687457,17.650397", place_index=index)
+            route = wrc.WazeRouteCalculator("47.45,19.2", "47.687457,17.650397", place_index=index)
+        assert addr_query.call_count == 1
+        assert route.start_coords == {"lat": 47.45, "lon": 19.2, "bounds": self.bounds}
+        assert route.end_coords["bounds"] == {}
 
     def test_get_route(self):
         with requests_mock.mock() as m:
@@ -540,3 +557,1118 @@ class TestWRC():
             route = wrc.WazeRouteCalculator(from_address, to_address, avoid_subscription_roads=False)
             route.get_route()
         assert 'subscription=' in req.last_request.query
+
+    def test_geocode_cache_hit(self):
+        cache = wrc.MemoryCache()
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            wrc.WazeRouteCalculator('From address', 'To address', geocode_cache=cache)
+            route = wrc.WazeRouteCalculator('from  ADDRESS', 'To address', geocode_cache=cache)
+        assert m.call_count == 2
+        assert route.start_coords == {'lat': self.lat, 'lon': self.lon, 'bounds': self.bounds}
+        assert cache.stats() == {"hits": 2, "misses": 2, "size": 2}
+
+    def test_geocode_cache_region(self):
+        cache = wrc.MemoryCache()
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.waze_url + "SearchServer/mozi", text=self.address_to_coords_response)
+            wrc.WazeRouteCalculator('From address', 'To address', geocode_cache=cache)
+            wrc.WazeRouteCalculator('From address', 'To address', region='US', geocode_cache=cache)
+        assert m.call_count == 4
+
+    def test_lazy_no_requests(self):
+        with requests_mock.mock() as m:
+            route = wrc.WazeRouteCalculator('From address', 'To address', lazy=True)
+        assert m.call_count == 0
+        assert route.start_address == 'From address'
+
+    def test_lazy_start_coords(self):
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            route = wrc.WazeRouteCalculator('From address', '47.687457,17.650397', lazy=True)
+            assert route.start_coords == {'lat': self.lat, 'lon': self.lon, 'bounds': self.bounds}
+            assert route.start_coords == {'lat': self.lat, 'lon': self.lon, 'bounds': self.bounds}
+        assert m.call_count == 1
+
+    def test_lazy_get_route(self):
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, text=self.routing_response)
+            route = wrc.WazeRouteCalculator('From address', 'To address', lazy=True)
+            time, dist = route.calc_route_info()
+        assert m.call_count == 3
+        assert sorted(req.qs['q'][0] for req in m.request_history[:2]) == ['from address', 'to address']
+        assert route.end_coords == {'lat': self.lat, 'lon': self.lon, 'bounds': self.bounds}
+        assert time == 1.00
+        assert dist == 0.40
+
+    def test_lazy_error_on_route(self):
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text='[]')
+            route = wrc.WazeRouteCalculator('From address', 'To address', lazy=True)
+            with pytest.raises(wrc.WRCError):
+                route.get_route()
+
+    def test_route_cache(self):
+        cache = wrc.RouteCache(ttl=60, time_bucket=10)
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            routing_query = m.get(self.routing_req, text=self.routing_response)
+            route = wrc.WazeRouteCalculator('From address', 'To address', route_cache=cache)
+            route.calc_route_info()
+            route.calc_route_info(time_delta=5)
+            route.calc_route_info(time_delta=10)
+            route.calc_all_routes_info()
+        assert routing_query.call_count == 3
+        assert cache.stats()["hits"] == 1
+
+    def test_add_up_route_numpy_matches(self):
+        pytest.importorskip("numpy")
+        rand = random.Random(42)
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            route = wrc.WazeRouteCalculator("", "")
+        route.start_coords = dict(route.start_coords, bounds={"left": 18.9, "right": 19.0, "bottom": 47.3, "top": 47.4})
+        results = []
+        for i in range(3000):
+            segment = {"length": rand.choice([rand.randint(1, 900), rand.random() * 900])}
+            if i % 3:
+                segment.update({"crossTime": rand.randint(1, 90), "crossTimeWithoutRealTime": rand.random() * 90})
+            else:
+                segment.update({"cross_time": rand.random() * 90, "cross_time_without_real_time": rand.randint(1, 90)})
+            if i % 5:
+                segment["path"] = {"x": rand.uniform(18.9, 19.4), "y": rand.uniform(47.3, 47.6)}
+            results.append(segment)
+        columns = wrc.Route.from_dict({"results": results})
+        assert route.VECTORIZE_MIN_SEGMENTS is None
+        for real_time in (True, False):
+            for stop_at_bounds in (True, False):
+                expected = route._add_up_route(results, real_time=real_time, stop_at_bounds=stop_at_bounds)
+                assert route._add_up_route(columns, real_time=real_time, stop_at_bounds=stop_at_bounds) == expected
+                with mock.patch.object(route, "VECTORIZE_MIN_SEGMENTS", 1000):
+                    assert route._add_up_route_numpy(columns, real_time, stop_at_bounds) == expected
+                    assert route._add_up_route(columns, real_time=real_time, stop_at_bounds=stop_at_bounds) == expected
+        assert route._add_up_route_numpy(wrc.Route.from_dict({"results": []}), True, True) == (0.0, 0.0)
+
+    def test_add_up_route_numpy_missing_key(self):
+        pytest.importorskip("numpy")
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            route = wrc.WazeRouteCalculator("", "")
+        results = [{"length": 1000, "crossTime": 120}] * 10
+        results.append({"length": 1000, "crossTime": 120, "path": {"x": 19.1, "y": 47.45}})
+        columns = wrc.Route.from_dict({"results": results})
+        with mock.patch.object(route, "VECTORIZE_MIN_SEGMENTS", 1):
+            assert route._add_up_route(columns, stop_at_bounds=True) == (20.0, 10.0)
+            with pytest.raises(KeyError):
+                route._add_up_route(columns, real_time=False)
+
+    def test_get_routes(self):
+        self.routing_response = '{"alternatives":[{"response":{"routeType":["Best"],"shortRouteName":"test1","results":[{"length":1000,"crossTime":120,"crossTimeWithoutRealTime":100,"path":{"x":19.1,"y":47.45}},{"length":1100,"crossTime":150,"crossTimeWithoutRealTime":120}]}},{"response":{"result":[{"length":500,"cross_time":60}]}}]}'
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, text=self.routing_response)
+            route = wrc.WazeRouteCalculator("", "")
+            routes = route.get_routes()
+        assert [r.key for r in routes] == ["Best-test1", "-unkown"]
+        assert len(routes[0]) == 2
+        assert routes[0].segment(0) == {"length": 1000, "crossTime": 120, "crossTimeWithoutRealTime": 100, "path": {"x": 19.1, "y": 47.45}}
+        assert routes[0].total() == (4.5, 2.1)
+        assert routes[0].total(real_time=False) == (220 / 60.0, 2.1)
+        assert route._add_up_route(routes[0], stop_at_bounds=True) == (2.5, 1.1)
+        assert routes[1].total() == (1.0, 0.5)
+        assert routes[1].to_dict() == {"routeType": [], "shortRouteName": "unkown", "results": [{"length": 500, "crossTime": 60}]}
+        with pytest.raises(KeyError):
+            routes[1].total(real_time=False)
+        assert not hasattr(routes[0], '__dict__')
+
+    def test_route_keep_raw(self):
+        response = {"routeType": ["Best"], "shortRouteName": "test1", "results": [{"length": 1000, "crossTime": 120, "instruction": {"opcode": "CONTINUE"}}]}
+        route = wrc.Route.from_dict(response, keep_raw=True)
+        assert route.to_dict() == response
+        assert route.route_type == ["Best"]
+        assert route.short_route_name == "test1"
+
+    def test_route_geometry(self):
+        coords = [{"x": 19.0, "y": 47.5, "z": "NaN"}, {"x": 19.05, "y": 47.5001}, {"x": 19.1, "y": 47.5}, {"x": 19.1, "y": 47.6}]
+        route = wrc.Route.from_dict({"results": [{"length": 1000, "crossTime": 120, "path": {"x": 19.0, "y": 47.5}}], "coords": coords})
+        assert route.total() == (2.0, 1.0)
+        geometry = route.geometry
+        assert geometry.x.typecode == geometry.y.typecode == 'd'
+        assert geometry.points() == [(47.5, 19.0), (47.5001, 19.05), (47.5, 19.1), (47.6, 19.1)]
+        assert geometry.simplify(0.001).points() == [(47.5, 19.0), (47.5, 19.1), (47.6, 19.1)]
+        assert geometry.simplify(0.00001).points() == geometry.points()
+        assert wrc.decode_polyline(geometry.polyline()) == geometry.points()
+        assert wrc.Route.from_dict({"results": [{"length": 1000, "crossTime": 120, "path": {"x": 19.0, "y": 47.5}}, {"length": 1, "crossTime": 1}]}).geometry.points() == [(47.5, 19.0)]
+
+    @pytest.mark.parametrize("alternatives", [None, 2])
+    def test_get_routes_geometry(self, alternatives):
+        from benchmarks.mock_server import routing_payload
+        payload = routing_payload(segments=5, alternatives=alternatives)
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, content=payload)
+            route = wrc.WazeRouteCalculator("From address", "To address")
+            routes = route.get_routes(npaths=alternatives or 1)
+        assert len(routes) == (alternatives or 1)
+        for number, result in enumerate(routes):
+            assert result._geometry is not None
+            assert len(result.geometry) == 5
+            assert result.geometry.points()[0] == (47.4979 + number * 0.0001, 19.0402)
+
+    def test_route_tracker(self):
+        now = [0.0]
+        routing_response = '{"response":{"results":[%s]}}' % ','.join(
+            '{"length":1000,"crossTime":%d,"path":{"x":%s,"y":47.5}}' % (60 * (i + 1), 19.0 + i * 0.1) for i in range(3))
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            routing_query = m.get(self.routing_req, text=routing_response)
+            route = wrc.WazeRouteCalculator("From address", "To address")
+            tracker = wrc.RouteTracker(route, refresh_interval=60, clock=lambda: now[0])
+            assert tracker.remaining() == (6.0, 3.0)
+            assert tracker.update(47.5001, 19.101) == (5.0, 2.0)
+            assert tracker.update(47.5, 19.2) == (3.0, 1.0)
+            assert routing_query.call_count == 1
+            assert tracker.update(47.6, 19.2) == (6.0, 3.0)
+            assert routing_query.call_count == 2
+            assert routing_query.last_request.qs["from"] == ["x:19.2 y:47.6"]
+            now[0] = 61
+            tracker.update(47.5, 19.1)
+            assert routing_query.call_count == 3
+        assert tracker.refreshes == 3
+        assert route.start_coords["lat"] == 47.4979
+
+    def test_route_tracker_long_segment(self):
+        from benchmarks.mock_server import routing_payload
+        payload = json.loads(routing_payload(segments=2))
+        payload["response"]["results"][1]["path"].update(x=19.5, y=47.5)
+        payload["coords"] = [{"x": 19.0402, "y": 47.4979}, {"x": 19.5, "y": 47.5}, {"x": 20.0, "y": 47.5}]
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            routing_query = m.get(self.routing_req, text=json.dumps(payload))
+            tracker = wrc.RouteTracker(wrc.WazeRouteCalculator("From address", "To address"))
+            assert tracker.update(47.499, 19.3) == (13 / 60.0, 0.161)
+            assert tracker.update(47.5, 19.9) == (7 / 60.0, 0.081)
+            assert routing_query.call_count == 1
+            tracker.update(47.6, 19.9)
+            assert routing_query.call_count == 2
+
+    def test_route_tracker_window(self):
+        # 200 segments of about 100 m going east
+        step = 0.1 / (111.32 * math.cos(math.radians(47.5)))
+        routing_response = json.dumps({
+            "response": {"results": [{"length": 100, "crossTime": 10, "path": {"x": 19.0 + i * step, "y": 47.5}} for i in range(200)]},
+            "coords": [{"x": 19.0 + i * step / 2, "y": 47.5} for i in range(401)],
+        })
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            routing_query = m.get(self.routing_req, text=routing_response)
+            tracker = wrc.RouteTracker(wrc.WazeRouteCalculator("From address", "To address"), lookahead=1.0)
+            with mock.patch.object(tracker, "_line_distance", wraps=tracker._line_distance) as line_distance:
+                assert tracker.update(47.5, 19.0 + 5.5 * step) == (195 * 10 / 60.0, 19.5)
+                assert tracker.update(47.5, 19.0 + 12.5 * step) == (188 * 10 / 60.0, 18.8)
+            assert line_distance.call_count < 2 * (11 + 40)
+            assert routing_query.call_count == 1
+            tracker.update(47.5, 19.0 + 100.5 * step)
+            assert routing_query.call_count == 2
+
+    def test_route_tracker_without_geometry(self):
+        now = [0.0]
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            routing_query = m.get(self.routing_req, text=self.routing_response)
+            route = wrc.WazeRouteCalculator("From address", "To address", summary_only=True)
+            tracker = wrc.RouteTracker(route, refresh_interval=60, clock=lambda: now[0])
+            assert tracker.update(10.0, 10.0) == tracker.remaining()
+            assert routing_query.call_count == 1
+            now[0] = 61
+            tracker.update(10.0, 10.0)
+            assert routing_query.call_count == 2
+
+    def test_process_backend(self):
+        self.routing_response = '{"alternatives":[{"response":{"routeType":["Best"],"shortRouteName":"test1","results":[{"length":1000,"crossTime":120,"path":{"x":19.1,"y":47.45}},{"length":1100,"crossTime":150}]}},{"response":{"results":[{"length":500,"crossTime":60}]}}]}'
+        with wrc.ProcessBackend(max_workers=1) as backend:
+            with requests_mock.mock() as m:
+                m.get(self.address_req, text=self.address_to_coords_response)
+                m.get(self.routing_req, text=self.routing_response)
+                route = wrc.WazeRouteCalculator("From address", "To address", backend=backend)
+                threaded = wrc.WazeRouteCalculator("From address", "To address")
+                assert route.calc_all_routes_info(stop_at_bounds=True) == threaded.calc_all_routes_info(stop_at_bounds=True)
+                assert route.calc_all_routes_info() == {"Best-test1": (4.5, 2.1), "-unkown": (1.0, 0.5)}
+                m.get(self.routing_req, text='{"error":"No route"}')
+                with pytest.raises(wrc.WRCError) as err:
+                    route.calc_route_info()
+        assert str(err.value) == "No route"
+
+    def test_polyline(self):
+        points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        assert wrc.encode_polyline(points) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+        assert wrc.decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@") == points
+
+    @pytest.mark.parametrize("decoder", ["json", "orjson"])
+    @pytest.mark.parametrize("response_text, npaths, expected", [
+        ('{"response":{"results":[{"length":400,"crossTime":60}]}}', 1, {"results": [{"length": 400, "crossTime": 60}]}),
+        ('{"response":{"results":[{"length":400,"crossTime":60}]}}', 3, [{"results": [{"length": 400, "crossTime": 60}]}]),
+        ('{"response":[{"result":[{"length":400,"cross_time":60}]}]}', 1, {"result": [{"length": 400, "cross_time": 60}]}),
+        ('{"alternatives":[{"response":{"results":[{"length":400,"crossTime":60}]}},{"response":{"results":[{"length":410,"crossTime":62}]}}]}', 3,
+         [{"results": [{"length": 400, "crossTime": 60}]}, {"results": [{"length": 410, "crossTime": 62}]}]),
+        ('{"response":{"results":[{"length":400,"crossTime":60,"path":{"x":19.1,"y":47.5},"street":"\u0150r utca"}]}}', 1,
+         {"results": [{"length": 400, "crossTime": 60, "path": {"x": 19.1, "y": 47.5}, "street": u"\u0150r utca"}]}),
+    ])
+    def test_route_response_shapes(self, decoder, response_text, npaths, expected):
+        loads = pytest.importorskip(decoder).loads
+        with mock.patch.object(sys.modules['WazeRouteCalculator.WazeRouteCalculator'], '_json_loads', loads):
+            with requests_mock.mock() as m:
+                m.get(self.address_req, text=self.address_to_coords_response)
+                m.get(self.routing_req, text=response_text)
+                route = wrc.WazeRouteCalculator("", "")
+                assert route.get_route(npaths) == expected
+
+    @pytest.mark.parametrize("decoder", ["json", "orjson"])
+    @pytest.mark.parametrize("response_kwargs, message", [
+        ({"text": '{"error":"No route"}'}, "No route"),
+        ({"text": '{}'}, "empty response"),
+        ({"text": 'not json'}, "empty response"),
+        ({"status_code": 500, "text": '{"response":{}}'}, "empty response"),
+        ({"text": '{"foo":1}'}, "wrong response"),
+        ({"text": '[1]'}, "wrong response"),
+        ({"text": '{"alternatives":[{}]}'}, "wrong response"),
+    ])
+    def test_route_response_errors(self, decoder, response_kwargs, message):
+        loads = pytest.importorskip(decoder).loads
+        with mock.patch.object(sys.modules['WazeRouteCalculator.WazeRouteCalculator'], '_json_loads', loads):
+            with requests_mock.mock() as m:
+                m.get(self.address_req, text=self.address_to_coords_response)
+                m.get(self.routing_req, **response_kwargs)
+                route = wrc.WazeRouteCalculator("", "")
+                with pytest.raises(wrc.WRCError) as err:
+                    route.get_route()
+        assert str(err.value) == message
+
+    def test_summary_only(self):
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            req = m.get(self.routing_req, text=self.routing_response)
+            route = wrc.WazeRouteCalculator("", "", summary_only=True)
+            time, dist = route.calc_route_info()
+        assert 'returngeometries=false' in req.last_request.query
+        assert 'returninstructions=false' in req.last_request.query
+        assert time == 1.00
+        assert dist == 0.40
+
+    def test_full_response_by_default(self):
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            req = m.get(self.routing_req, text=self.routing_response)
+            route = wrc.WazeRouteCalculator("", "")
+            route.get_route()
+        assert 'returngeometries=true' in req.last_request.query
+        assert 'returninstructions=true' in req.last_request.query
+
+    def test_calc_route_time_series(self):
+        minutes = {0: 60, 15: 50, 30: 42, 45: 41, 60: 43, 75: 55}
+
+        def routing_callback(request, context):
+            return '{"response":{"results":[{"length":1000,"crossTime":%d}]}}' % (minutes[int(request.qs["at"][0])] * 60)
+
+        with requests_mock.mock() as m:
+            address_query = m.get(self.address_req, text=self.address_to_coords_response)
+            routing_query = m.get(self.routing_req, text=routing_callback)
+            route = wrc.WazeRouteCalculator("", "")
+            time_series = route.calc_route_time_series(range(0, 90, 15), max_workers=3)
+        assert address_query.call_count == 2
+        assert routing_query.call_count == 6
+        assert time_series.series == [(delta, float(minutes[delta]), 1.0) for delta in range(0, 90, 15)]
+        assert time_series.best == (45, 41.0, 1.0)
+        assert time_series.window == (30, 60)
+
+    @pytest.mark.parametrize("response_text, message", [
+        ('{"error":"No route"}', "No route"),
+        ('{"response":{"foo":1}}', "wrong response"),
+    ])
+    def test_calc_route_time_series_error(self, response_text, message):
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, text=response_text)
+            route = wrc.WazeRouteCalculator("", "")
+            with pytest.raises(wrc.WRCError) as err:
+                route.calc_route_time_series([0, 15])
+        assert str(err.value) == message
+
+    def test_calc_route_time_series_empty(self):
+        with requests_mock.mock() as m:
+            route = wrc.WazeRouteCalculator("", "", lazy=True)
+            assert route.calc_route_time_series([]) == wrc.TimeSeries([], None, None)
+        assert m.call_count == 0
+
+    def test_stats_hooks(self):
+        stats = wrc.StatsCollector()
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, [{'status_code': 503}, {'text': self.routing_response}])
+            session = wrc.WazeSession(retries=1, backoff_factor=0)
+            route = wrc.WazeRouteCalculator('From address', 'To address', session=session, hooks=stats)
+            route.calc_route_info()
+        summary = stats.summary()
+        assert sorted(summary["phases"]) == ["add_up", "geocode", "geocode_decode", "routing", "routing_decode"]
+        assert summary["phases"]["geocode"]["count"] == 2
+        assert summary["requests"]["geocode"]["count"] == 2
+        assert summary["requests"]["geocode"]["bytes"] == 2 * len(self.address_to_coords_response)
+        assert summary["requests"]["routing"]["status"] == {200: 1}
+        assert summary["requests"]["routing"]["retries"] == 1
+        assert summary["requests"]["routing"]["bytes"] == len(self.routing_response)
+        assert summary["segments"] == 1
+
+    def test_stats_hooks_failed_request(self):
+        stats = wrc.StatsCollector()
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, exc=wrc.requests.ConnectTimeout)
+            session = wrc.WazeSession(retries=2, backoff_factor=0)
+            route = wrc.WazeRouteCalculator('From address', 'To address', session=session, hooks=stats)
+            with pytest.raises(wrc.requests.ConnectTimeout):
+                route.calc_route_info()
+        summary = stats.summary()
+        assert summary["requests"]["routing"]["status"] == {"ConnectTimeout": 1}
+        assert summary["requests"]["routing"]["retries"] == 2
+        assert summary["requests"]["routing"]["bytes"] == 0
+        assert summary["phases"]["routing"]["count"] == 1
+
+    def test_prometheus_hooks(self):
+        prometheus_client = pytest.importorskip("prometheus_client")
+        registry = prometheus_client.CollectorRegistry()
+        hooks = wrc.PrometheusHooks(registry=registry)
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, text=self.routing_response)
+            route = wrc.WazeRouteCalculator('From address', 'To address', hooks=hooks)
+            route.calc_route_info()
+        assert registry.get_sample_value('waze_requests_total', {'endpoint': 'geocode', 'status': '200'}) == 2
+        assert registry.get_sample_value('waze_phase_seconds_count', {'phase': 'routing'}) == 1
+        assert registry.get_sample_value('waze_route_segments_sum') == 1
+
+
+class TestCache():
+
+    def test_memory_cache_lru(self):
+        cache = wrc.MemoryCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert len(cache) == 2
+
+    def test_memory_cache_ttl(self):
+        cache = wrc.MemoryCache(ttl=10)
+        with mock.patch("time.monotonic", return_value=100):
+            cache.set("a", 1)
+            cache.set("b", 2, ttl=100)
+        with mock.patch("time.monotonic", return_value=105):
+            assert cache.get("a") == 1
+        with mock.patch("time.monotonic", return_value=111):
+            assert cache.get("a") is None
+            assert cache.get("b") == 2
+        assert cache.hits == 2
+        assert cache.misses == 1
+
+    def test_sqlite_cache_persistent(self, tmp_path):
+        path = str(tmp_path / "geocode.db")
+        cache = wrc.SQLiteCache(path)
+        cache.set("a", {"lat": 1.5, "lon": 2.5, "bounds": {}})
+        cache.close()
+        cache = wrc.SQLiteCache(path)
+        assert cache.get("a") == {"lat": 1.5, "lon": 2.5, "bounds": {}}
+        assert cache.get("b") is None
+        assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    def test_sqlite_cache_ttl_and_eviction(self, tmp_path):
+        cache = wrc.SQLiteCache(str(tmp_path / "geocode.db"), maxsize=2, ttl=10)
+        with mock.patch("time.time", return_value=100):
+            cache.set("a", 1)
+        with mock.patch("time.time", return_value=101):
+            cache.set("b", 2)
+        with mock.patch("time.time", return_value=102):
+            cache.set("c", 3)
+        assert len(cache) == 2
+        with mock.patch("time.time", return_value=105):
+            assert cache.get("a") is None
+            assert cache.get("c") == 3
+        with mock.patch("time.time", return_value=120):
+            assert cache.get("c") is None
+
+    def test_route_cache_key(self):
+        cache = wrc.RouteCache(precision=3, time_bucket=15)
+        params = {"from": "x:19.04021 y:47.49791", "to": "x:17.65 y:47.68", "at": 14, "nPaths": 1}
+        key = cache.key("url", params)
+        assert key == cache.key("url", dict(params, **{"from": "x:19.0398 y:47.4982", "at": 0}))
+        assert key != cache.key("url", dict(params, at=15))
+        assert key != cache.key("url", dict(params, nPaths=3))
+        assert key != cache.key("other", params)
+
+    def test_route_cache_single_fetch(self):
+        cache = wrc.RouteCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"results": []}
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            first = executor.submit(cache.get_or_fetch, "key", fetch)
+            started.wait(5)
+            others = [executor.submit(cache.get_or_fetch, "key", fetch) for _ in range(3)]
+            time.sleep(0.05)
+            release.set()
+            results = [first.result()] + [future.result() for future in others]
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+
+    def test_route_cache_shared_error(self):
+        cache = wrc.RouteCache()
+        with pytest.raises(wrc.WRCError):
+            cache.get_or_fetch("key", mock.Mock(side_effect=wrc.WRCError("No route")))
+        assert cache.get("key") is None
+
+    def test_single_flight_shared_error(self):
+        flight = wrc.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch():
+            started.set()
+            release.wait(5)
+            raise wrc.WRCError("No route")
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            first = executor.submit(flight.do, "key", fetch)
+            started.wait(5)
+            others = [executor.submit(flight.do, "key", fetch) for _ in range(2)]
+            while flight.stats()["shared"] < 2:
+                time.sleep(0.001)
+            release.set()
+            errors = [future.exception() for future in [first] + others]
+        assert all(isinstance(error, wrc.WRCError) and str(error) == "No route" for error in errors)
+        assert flight.stats() == {"calls": 1, "shared": 2, "in_flight": 0}
+
+    def test_place_index(self, tmp_path):
+        index = wrc.PlaceIndex(cell_size=0.1)
+        index.add("Region", {"lat": 47.5, "lon": 19.0, "bounds": {"left": 18.5, "right": 19.5, "bottom": 47.0, "top": 48.0}})
+        index.add("City", {"lat": 47.5, "lon": 19.05, "bounds": {"left": 19.0, "right": 19.1, "bottom": 47.45, "top": 47.55}})
+        index.add("Point", {"lat": 47.5, "lon": 19.05, "bounds": {}})
+        assert index.lookup(47.5, 19.05)[0] == "City"
+        assert index.lookup(47.2, 18.7)[0] == "Region"
+        assert index.lookup(46.0, 19.0) is None
+        index.add("City", {"lat": 46.05, "lon": 19.05, "bounds": {"left": 19.0, "right": 19.1, "bottom": 46.0, "top": 46.1}})
+        assert index.lookup(47.5, 19.05)[0] == "Region"
+        path = str(tmp_path / "places.json")
+        index.save(path)
+        loaded = wrc.PlaceIndex.load(path)
+        assert len(loaded) == 3
+        assert loaded.lookup(46.05, 19.02) == ("City", index.get("City"))
+        assert loaded.snap({"lat": 47.2, "lon": 18.7, "bounds": {}})["bounds"]["left"] == 18.5
+        assert len(wrc.PlaceIndex.load(str(tmp_path / "missing.json"))) == 0
+
+
+class TestSession():
+
+    def setup_method(self, method):
+        self.address_req = "https://www.waze.com/row-SearchServer/mozi"
+        self.routing_req = "https://routing-livemap-row.waze.com/RoutingManager/routingRequest"
+        self.am_routing_req = "https://routing-livemap-am.waze.com/RoutingManager/routingRequest"
+        self.address_to_coords_response = '[{"city":"Test","location":{"lat":47.4979,"lon":19.0402},"bounds":null}]'
+        self.routing_response = '{"response":{"results":[{"length":400,"crossTime":60}]}}'
+
+    def test_shared_session(self):
+        session = wrc.WazeSession(timeout=5)
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, text=self.routing_response)
+            for _ in range(2):
+                route = wrc.WazeRouteCalculator("From address", "To address", session=session)
+                route.calc_route_info()
+        assert m.call_count == 6
+        assert all(req.timeout == 5 for req in m.request_history)
+        assert session.session.get_adapter(self.routing_req) is not session.session.get_adapter(self.address_req)
+
+    def test_session_retry(self):
+        session = wrc.WazeSession(retries=2, backoff_factor=0)
+        with requests_mock.mock() as m:
+            m.get(self.address_req, [{'status_code': 503}, {'text': self.address_to_coords_response}])
+            response = session.get(self.address_req)
+        assert response.ok
+        assert response.retries == 1
+        assert m.call_count == 2
+
+    def test_session_retry_exhausted(self):
+        session = wrc.WazeSession(retries=1, backoff_factor=0)
+        with requests_mock.mock() as m:
+            m.get(self.address_req, exc=wrc.requests.ConnectTimeout)
+            with pytest.raises(wrc.requests.ConnectTimeout):
+                session.get(self.address_req)
+        assert m.call_count == 2
+
+    def test_failover(self):
+        session = wrc.WazeSession(retries=2, backoff_factor=0)
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            row = m.get(self.routing_req, exc=wrc.requests.ConnectTimeout)
+            am = m.get(self.am_routing_req, text=self.routing_response)
+            route = wrc.WazeRouteCalculator("From address", "To address", session=session)
+            with pytest.raises(wrc.requests.ConnectTimeout):
+                route.calc_route_info()
+            assert row.call_count == 3
+            assert am.call_count == 0
+            with mock.patch.dict(wrc.WazeRouteCalculator.ALTERNATE_ROUTING_SERVERS, {'EU': [self.am_routing_req]}):
+                assert route.calc_route_info() == (1.0, 0.4)
+        assert row.call_count == 5
+        assert am.call_count == 1
+
+    def test_retry_same_server_first(self):
+        session = wrc.WazeSession(retries=1, backoff_factor=0)
+        with requests_mock.mock() as m:
+            row = m.get(self.routing_req, [{'status_code': 503}, {'text': 'row'}])
+            am = m.get(self.am_routing_req, text='am')
+            response = session.get(self.routing_req, alternates=[self.am_routing_req])
+        assert response.text == 'row'
+        assert row.call_count == 2
+        assert am.call_count == 0
+
+    def test_backoff_jitter(self):
+        session = wrc.WazeSession(backoff_factor=1)
+        delays = [session.backoff(2) for _ in range(50)]
+        assert all(0 <= delay <= 4 for delay in delays)
+        assert len(set(delays)) > 1
+        session.jitter = False
+        assert session.backoff(2) == 4
+
+    def test_hedged_request(self):
+        from benchmarks.mock_server import MockWazeServer
+        session = wrc.WazeSession(hedge_after=0.05)
+        with MockWazeServer(latency=0.5, geocode=b'["slow"]') as slow, MockWazeServer(geocode=b'["fast"]') as fast:
+            start = time.time()
+            response = session.get(slow.url + 'SearchServer/mozi', alternates=[fast.url + 'SearchServer/mozi'])
+            elapsed = time.time() - start
+        session.close()
+        assert response.text == '["fast"]'
+        assert elapsed < 0.4
+
+    def test_hedge_timer_starts_at_send(self):
+        from benchmarks.mock_server import MockWazeServer
+        session = wrc.WazeSession(hedge_after=0.1)
+        with MockWazeServer(latency=0.05, geocode=b'["primary"]') as primary, MockWazeServer(geocode=b'["hedge"]') as hedge:
+            response = session.get(primary.url + 'SearchServer/mozi', alternates=[hedge.url + 'SearchServer/mozi'], acquire=lambda: time.sleep(0.2))
+        session.close()
+        assert response.text == '["primary"]'
+        assert hedge.requests == 0
+
+    def test_hedged_request_primary_in_time(self):
+        session = wrc.WazeSession(hedge_after=1)
+        with requests_mock.mock() as m:
+            primary = m.get(self.routing_req, text='primary')
+            hedge = m.get(self.am_routing_req, text='hedge')
+            response = session.get(self.routing_req, alternates=[self.am_routing_req])
+        session.close()
+        assert response.text == 'primary'
+        assert primary.call_count == 1
+        assert hedge.call_count == 0
+
+    def test_hedged_error_payload_waits_for_primary(self):
+        from benchmarks.mock_server import MockWazeServer
+        session = wrc.WazeSession(hedge_after=0.05)
+        with MockWazeServer(latency=0.3, geocode=b'["slow"]') as slow, MockWazeServer(geocode=b'\xef\xbb\xbf{ "error": "Unknown region"}') as foreign:
+            response = session.get(slow.url + 'SearchServer/mozi', alternates=[foreign.url + 'SearchServer/mozi'])
+        session.close()
+        assert response.text == '["slow"]'
+        assert session.good_answer(response)
+
+    @pytest.mark.parametrize("content, good", [
+        (b'{"response":{}}', True),
+        (b'{ "error": "No route"}', False),
+        (b'  {"error":"No route"}', False),
+        (b'\xef\xbb\xbf{"error":"No route"}', False),
+        (b'not json', False),
+    ])
+    def test_good_answer(self, content, good):
+        response = wrc.requests.Response()
+        response.status_code = 200
+        response._content = content
+        assert wrc.WazeSession.good_answer(response) == good
+
+    def test_timeout_without_session(self):
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            wrc.WazeRouteCalculator("From address", "To address")
+        assert m.request_history[0].timeout == wrc.WazeRouteCalculator.HTTP_TIMEOUT
+
+    def test_token_bucket(self):
+        bucket = wrc.TokenBucket(rate=10, burst=2)
+        assert bucket.try_acquire() == 0
+        assert bucket.try_acquire() == 0
+        assert 0 < bucket.try_acquire() <= 0.1
+        start = time.monotonic()
+        bucket.acquire()
+        assert time.monotonic() - start >= 0.05
+
+    def test_scheduler_priority(self):
+        scheduler = wrc.RequestScheduler(rate=2, burst=1)
+        scheduler.acquire('routing')
+        order = []
+
+        def request(priority):
+            scheduler.acquire('routing', priority)
+            order.append(priority)
+
+        bulk = threading.Thread(target=request, args=(wrc.PRIORITY_BULK,))
+        bulk.start()
+        while scheduler.queue_depth('routing') < 1:
+            time.sleep(0.001)
+        interactive = threading.Thread(target=request, args=(wrc.PRIORITY_INTERACTIVE,))
+        interactive.start()
+        bulk.join()
+        interactive.join()
+        assert order == [wrc.PRIORITY_INTERACTIVE, wrc.PRIORITY_BULK]
+        stats = scheduler.stats()
+        assert stats["queue_depth"] == {"routing": 0}
+        assert stats["priorities"][wrc.PRIORITY_BULK]["count"] == 1
+        assert stats["priorities"][wrc.PRIORITY_BULK]["wait_max"] > 0.5
+
+    def test_scheduler_shared(self):
+        scheduler = wrc.RequestScheduler(rate=100, endpoint_rates={'geocode': (1000, 10)})
+        with mock.patch.object(scheduler, 'acquire', wraps=scheduler.acquire) as acquire:
+            with requests_mock.mock() as m:
+                m.get(self.address_req, text=self.address_to_coords_response)
+                m.get(self.routing_req, text=self.routing_response)
+                for _ in range(2):
+                    route = wrc.WazeRouteCalculator("From address", "To address", scheduler=scheduler)
+                    route.calc_route_info()
+                wrc.calc_route_matrix(["From address"], ["To address"], scheduler=scheduler)
+        calls = [call[0] for call in acquire.call_args_list]
+        assert calls[:6] == [('geocode', wrc.PRIORITY_INTERACTIVE)] * 2 + [('routing', wrc.PRIORITY_INTERACTIVE)] + [('geocode', wrc.PRIORITY_INTERACTIVE)] * 2 + [('routing', wrc.PRIORITY_INTERACTIVE)]
+        assert ('routing', wrc.PRIORITY_BULK) in calls[6:]
+        assert scheduler._bucket('geocode').burst == 10
+
+    def test_scheduler_token_per_retry(self):
+        scheduler = wrc.RequestScheduler(rate=1000)
+        session = wrc.WazeSession(retries=2, backoff_factor=0)
+        with mock.patch.object(scheduler, 'acquire', wraps=scheduler.acquire) as acquire:
+            with requests_mock.mock() as m:
+                m.get(self.routing_req, [{'status_code': 429, 'headers': {'Retry-After': '0.05'}}, {'status_code': 503}, {'text': self.routing_response}])
+                route = wrc.WazeRouteCalculator({"lat": 1, "lon": 2, "bounds": {}}, {"lat": 3, "lon": 4, "bounds": {}}, session=session, scheduler=scheduler)
+                start = time.monotonic()
+                assert route.calc_route_info() == (1.0, 0.4)
+                assert time.monotonic() - start >= 0.05
+        assert [call[0] for call in acquire.call_args_list] == [('routing', wrc.PRIORITY_INTERACTIVE)] * 3
+
+    def test_single_flight_geocode(self):
+        from benchmarks.mock_server import MockWazeServer
+        flight = wrc.SingleFlight()
+        with MockWazeServer(latency=0.2) as server:
+            calculator = server.calculator_class()
+            routes = [calculator(None, None, lazy=True, single_flight=flight) for _ in range(5)]
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                coords = list(executor.map(lambda route: route.address_to_coords("Mock start"), routes))
+        assert server.requests == 1
+        assert all(result == coords[0] for result in coords)
+        assert flight.stats()["shared"] == 4
+
+    def test_record_replay(self, tmp_path):
+        path = str(tmp_path / "waze.rec")
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_to_coords_response)
+            m.get(self.routing_req, text=self.routing_response)
+            with wrc.RecordingSession(path) as recorder:
+                route = wrc.WazeRouteCalculator("From address", "To address", session=recorder)
+                expected = route.calc_route_info()
+            calls = m.call_count
+            with wrc.ReplaySession(path) as replay:
+                assert len(replay) == 3
+                for _ in range(3):
+                    route = wrc.WazeRouteCalculator("From address", "To address", session=replay)
+                    assert route.calc_route_info() == expected
+                with pytest.raises(wrc.WRCError):
+                    route.calc_route_info(time_delta=10)
+            assert m.call_count == calls
+            with wrc.RecordingSession(path, append=True) as recorder:
+                wrc.WazeRouteCalculator("Other address", "To address", session=recorder)
+        with wrc.ReplaySession(path, latency=0.05) as replay:
+            assert len(replay) == 4
+            start = time.time()
+            response = replay.get(self.address_req.replace("www.waze.com", "other.host"), params={"q": "Other address", "lang": "eng", "origin": "livemap", "lat": 47.498, "lon": 19.04})
+            assert time.time() - start >= 0.05
+        assert response.json()[0]["city"] == "Test"
+
+
+class TestBatch():
+
+    def setup_method(self, method):
+        self.address_req = "https://www.waze.com/row-SearchServer/mozi"
+        self.routing_req = "https://routing-livemap-row.waze.com/RoutingManager/routingRequest"
+        self.places = {"a": (47.1, 19.1), "b": (47.2, 19.2), "c": (47.3, 19.3)}
+
+    def address_callback(self, request, context):
+        place = request.qs["q"][0]
+        if place not in self.places:
+            return '[]'
+        lat, lon = self.places[place]
+        return '[{"city":"Test","location":{"lat":%s,"lon":%s},"bounds":null}]' % (lat, lon)
+
+    def routing_callback(self, request, context):
+        x = float(request.qs["from"][0].split()[0][2:])
+        if x == 19.3:
+            return '{"error":"No route"}'
+        return '{"response":{"results":[{"length":%d,"crossTime":%d}]}}' % (x * 100, x * 10)
+
+    def test_calc_route_matrix(self):
+        with requests_mock.mock() as m:
+            address_query = m.get(self.address_req, text=self.address_callback)
+            routing_query = m.get(self.routing_req, text=self.routing_callback)
+            matrix = wrc.calc_route_matrix(["A", "B", "C"], ["B", "X"], max_workers=4)
+        assert address_query.call_count == 4
+        assert routing_query.call_count == 2
+        assert matrix.times == [[191 / 60.0, None], [0.0, None], [None, None]]
+        assert matrix.distances == [[1.91, None], [0.0, None], [None, None]]
+        assert sorted(matrix.errors) == [(0, 1), (1, 1), (2, 0), (2, 1)]
+        assert str(matrix.errors[(2, 0)]) == "No route"
+        assert str(matrix.errors[(0, 1)]) == "Cannot get coords for X"
+
+    def test_calc_route_matrix_bad_answers(self):
+        def address_callback(request, context):
+            if request.qs["q"][0] == "b":
+                context.status_code = 429
+                return ''
+            if request.qs["q"][0] == "x":
+                return 'not json'
+            return self.address_callback(request, context)
+
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=address_callback)
+            m.get(self.routing_req, text='{"foo":1}')
+            matrix = wrc.calc_route_matrix(["A", "B"], ["C", "X"], max_workers=4)
+        assert matrix.times == [[None, None], [None, None]]
+        assert str(matrix.errors[(0, 0)]) == "wrong response"
+        assert str(matrix.errors[(1, 0)]) == "Cannot get coords for B: HTTP 429"
+        assert str(matrix.errors[(0, 1)]) == "Cannot get coords for X: invalid response"
+
+    def test_route_from_resolved_coords(self):
+        with requests_mock.mock() as m:
+            address_query = m.get(self.address_req, text=self.address_callback)
+            route = wrc.WazeRouteCalculator({"lat": 1, "lon": 2, "bounds": {}}, "b")
+        assert address_query.call_count == 1
+        assert route.start_coords == {"lat": 1, "lon": 2, "bounds": {}}
+
+    def test_normalize_inputs(self):
+        inputs = wrc.normalize_inputs(["A", "47.5,19.04", "B", "A", "-33.8, 151.2", "1.5 street"])
+        assert inputs.addresses == ["A", "B", "1.5 street"]
+        assert list(inputs.address_index) == [0, -1, 1, 0, -1, 2]
+        assert inputs.lat[1] == 47.5 and inputs.lon[1] == 19.04
+        assert inputs.lat[4] == -33.8 and inputs.lon[4] == 151.2
+        assert inputs.lat[0] != inputs.lat[0]
+
+    def test_resolve_inputs(self):
+        with requests_mock.mock() as m:
+            address_query = m.get(self.address_req, text=self.address_callback)
+            inputs, errors = wrc.resolve_inputs(["A", "47.5,19.04", "X", "A", "B"], max_workers=2)
+        assert address_query.call_count == 3
+        assert list(inputs.lat[:2]) == [47.1, 47.5]
+        assert list(inputs.lon[3:]) == [19.1, 19.2]
+        assert inputs.lat[2] != inputs.lat[2]
+        assert list(errors) == ["X"]
+
+    def test_calc_multi_stop_route(self):
+        with requests_mock.mock() as m:
+            address_query = m.get(self.address_req, text=self.address_callback)
+            routing_query = m.get(self.routing_req, text=self.routing_callback)
+            route = wrc.calc_multi_stop_route(["A", "B", "A", "B"], max_workers=3)
+        assert address_query.call_count == 2
+        assert routing_query.call_count == 3
+        assert route.legs == [(191 / 60.0, 1.91), (192 / 60.0, 1.92), (191 / 60.0, 1.91)]
+        assert route.time == sum(leg[0] for leg in route.legs)
+        assert route.distance == 1.91 + 1.92 + 1.91
+
+    def test_calc_multi_stop_route_error(self):
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_callback)
+            m.get(self.routing_req, text=self.routing_callback)
+            with pytest.raises(wrc.WRCError) as err:
+                wrc.calc_multi_stop_route(["A", "C", "B"])
+        assert str(err.value) == "leg 1 (C - B): No route"
+        with pytest.raises(wrc.WRCError):
+            wrc.calc_multi_stop_route(["A"])
+
+    def test_optimize_stop_order(self):
+        def routing_callback(request, context):
+            x_from = float(request.qs["from"][0].split()[0][2:])
+            x_to = float(request.qs["to"][0].split()[0][2:])
+            return '{"response":{"results":[{"length":%d,"crossTime":%d}]}}' % (round(abs(x_to - x_from) * 10000), round(abs(x_to - x_from) * 6000))
+
+        pair_cache = wrc.MemoryCache()
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_callback)
+            routing_query = m.get(self.routing_req, text=routing_callback)
+            result = wrc.optimize_stop_order(["A", "C", "B"], pair_cache=pair_cache)
+            assert routing_query.call_count == 6
+            closed = wrc.optimize_stop_order(["A", "C", "B"], return_to_start=True, pair_cache=pair_cache)
+            assert routing_query.call_count == 6
+        assert result.order == [0, 2, 1]
+        assert result.stops == ["A", "B", "C"]
+        assert round(result.time, 6) == 20.0
+        assert round(result.distance, 6) == 2.0
+        assert closed.order in ([0, 2, 1], [0, 1, 2])
+        assert round(closed.time, 6) == 40.0
+
+    def test_solve_order(self):
+        points = [0, 7, 3, 9, 1, 5]
+        cost = [[abs(a - b) for b in points] for a in points]
+        assert wrc.optimize.solve_order(cost) == [0, 4, 2, 5, 1, 3]
+        rand = random.Random(1)
+        cost = [[rand.random() for _ in range(60)] for _ in range(60)]
+        order = wrc.optimize.solve_order(cost, return_to_start=True)
+        assert order[0] == 0
+        assert sorted(order) == list(range(60))
+
+    def test_cli_run(self, tmp_path):
+        from WazeRouteCalculator import cli
+        rows = "from,to\na,b\nc,a\nb,a\n"
+        (tmp_path / "pairs.csv").write_text(rows)
+        (tmp_path / "head.csv").write_text(rows[:rows.index("b,a")])
+        output = str(tmp_path / "out.csv")
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_callback)
+            m.get(self.routing_req, text=self.routing_callback)
+            cli.run(str(tmp_path / "pairs.csv"), output, max_workers=2, checkpoint_every=1)
+            full = (tmp_path / "out.csv").read_text()
+            cli.run(str(tmp_path / "head.csv"), output, max_workers=2)
+            routing_query = m.get(self.routing_req, text=self.routing_callback)
+            stats = cli.run(str(tmp_path / "pairs.csv"), output, resume=True)
+        assert routing_query.call_count == 1
+        assert stats["rows"] == 3 and stats["failed"] == 1 and stats["processed"] == 1
+        assert (tmp_path / "out.csv").read_text() == full
+        assert full.splitlines() == ["row,from,to,route,time,distance", "0,a,b,,%r,%r" % (191 / 60.0, 1.91), "2,b,a,,%r,%r" % (192 / 60.0, 1.92)]
+        assert (tmp_path / "out.csv.errors").read_text().splitlines() == ["row,from,to,error", "1,c,a,No route"]
+
+    def test_cli_bad_rows(self, tmp_path):
+        from WazeRouteCalculator import cli
+
+        def address_callback(request, context):
+            if request.qs["q"][0] == "x":
+                return '<html>busy</html>'
+            return self.address_callback(request, context)
+
+        def routing_callback(request, context):
+            if request.qs["from"][0].startswith("x:19.2"):
+                raise ValueError("broken")
+            return self.routing_callback(request, context)
+
+        (tmp_path / "pairs.csv").write_text("from,to\na,b\nx,a\nb,a\n")
+        output = str(tmp_path / "out.csv")
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=address_callback)
+            m.get(self.routing_req, text=routing_callback)
+            stats = cli.run(str(tmp_path / "pairs.csv"), output, max_workers=2)
+        assert stats["rows"] == 3 and stats["failed"] == 2
+        assert (tmp_path / "out.csv").read_text().splitlines() == ["row,from,to,route,time,distance", "0,a,b,,%r,%r" % (191 / 60.0, 1.91)]
+        assert (tmp_path / "out.csv.errors").read_text().splitlines() == [
+            "row,from,to,error", "1,x,a,Cannot get coords for x: invalid response", "2,b,a,ValueError: broken"]
+
+    def test_cli_bad_jsonl_lines(self, tmp_path):
+        from WazeRouteCalculator import cli
+        (tmp_path / "pairs.jsonl").write_text('{"from":"a","to":"b"}\n{"from":"a",\n[1,2]\n{"from":"b","to":"a"}\n')
+        output = str(tmp_path / "out.jsonl")
+        with requests_mock.mock() as m:
+            m.get(self.address_req, text=self.address_callback)
+            m.get(self.routing_req, text=self.routing_callback)
+            stats = cli.run(str(tmp_path / "pairs.jsonl"), output, max_workers=2)
+        assert stats["rows"] == 4 and stats["failed"] == 2
+        assert [json.loads(line)["row"] for line in (tmp_path / "out.jsonl").read_text().splitlines()] == [0, 3]
+        errors = [json.loads(line) for line in (tmp_path / "out.jsonl.errors").read_text().splitlines()]
+        assert [(error["row"], error["from"]) for error in errors] == [(1, None), (2, None)]
+        assert errors[0]["error"].startswith("invalid JSON")
+        assert errors[1]["error"] == "not a JSON object"
+
+    def test_calc_isochrone(self):
+        origin = (47.5, 19.0)
+
+        def km_from_origin(request):
+            x, y = [float(part[2:]) for part in request.qs["to"][0].split()]
+            return math.hypot((y - origin[0]) * 111.32, (x - origin[1]) * 111.32 * math.cos(math.radians(origin[0])))
+
+        def routing_callback(request, context):
+            km = km_from_origin(request)
+            if km > 40:
+                return '{"error":"No route"}'
+            return '{"response":{"results":[{"length":%r,"crossTime":%r}]}}' % (km * 1000, km * 60)
+
+        cache = wrc.MemoryCache()
+        with requests_mock.mock() as m:
+            routing_query = m.get(self.routing_req, text=routing_callback)
+            result = wrc.calc_isochrone("47.5,19.0", [20, 30], rays=8, refine=2, pair_cache=cache)
+            assert result.calls == routing_query.call_count <= 8 * 3 + 8 * 2 * 2
+            # failed routes are not cached
+            assert wrc.calc_isochrone("47.5,19.0", [20, 30], rays=8, refine=2, pair_cache=cache).calls == 8
+        assert sorted(result.polygons) == [20, 30]
+        for threshold, ring in result.polygons.items():
+            assert len(ring) == 9 and ring[0] == ring[-1]
+            for lat, lon in ring:
+                km = math.hypot((lat - origin[0]) * 111.32, (lon - origin[1]) * 111.32 * math.cos(math.radians(origin[0])))
+                assert abs(km - threshold) < 0.01
+
+
+class FakeAsyncResponse():
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    async def read(self):
+        await wrc.aio.asyncio.sleep(0)
+        return self.body.encode('utf-8')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeAsyncClient():
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append((url, params))
+        return FakeAsyncResponse(200, self.responses[url])
+
+
+class TestAsync():
+
+    def setup_method(self, method):
+        self.address_req = "https://www.waze.com/row-SearchServer/mozi"
+        self.routing_req = "https://routing-livemap-row.waze.com/RoutingManager/routingRequest"
+        self.client = FakeAsyncClient({
+            self.address_req: '[{"city":"Test","location":{"lat":47.4979,"lon":19.0402},"bounds":null}]',
+            self.routing_req: '{"alternatives":[{"response":{"routeType":["Best"],"shortRouteName":"test1","results":[{"length":1000,"crossTime":120}]}},{"response":{"routeType":["Normal"],"shortRouteName":"test2","results":[{"length":1100,"crossTime":150}]}}]}',
+        })
+        self.session = wrc.AsyncWazeSession(limit=2, client=self.client)
+
+    def test_calc_route_info(self):
+        self.client.responses[self.routing_req] = '{"response":{"results":[{"length":1000,"crossTime":120}]}}'
+
+        async def calc():
+            route = wrc.AsyncWazeRouteCalculator("From address", "To address", session=self.session)
+            return await route.calc_route_info()
+        assert wrc.aio.asyncio.run(calc()) == (2.0, 1.0)
+        assert [url for url, params in self.client.requests] == [self.address_req, self.address_req, self.routing_req]
+        assert self.client.requests[2][1]["nPaths"] == "1"
+
+    def test_calc_all_routes_info(self):
+        async def calc():
+            route = wrc.AsyncWazeRouteCalculator("47.1,19.1", "47.2,19.2", session=self.session)
+            return await route.calc_all_routes_info()
+        assert wrc.aio.asyncio.run(calc()) == {"Best-test1": (2.0, 1.0), "Normal-test2": (2.5, 1.1)}
+        assert len(self.client.requests) == 1
+
+    def test_concurrent_routes(self):
+        self.client.responses[self.routing_req] = '{"response":{"results":[{"length":1000,"crossTime":120}]}}'
+
+        async def calc():
+            routes = [wrc.AsyncWazeRouteCalculator("47.1,19.1", "47.2,19.2", session=self.session) for _ in range(5)]
+            return await wrc.aio.asyncio.gather(*[route.calc_route_info() for route in routes])
+        assert wrc.aio.asyncio.run(calc()) == [(2.0, 1.0)] * 5
+
+    def test_address_error(self):
+        self.client.responses[self.address_req] = '[]'
+
+        async def calc():
+            route = wrc.AsyncWazeRouteCalculator("From address", "To address", session=self.session)
+            return await route.calc_route_info()
+        with pytest.raises(wrc.WRCError):
+            wrc.aio.asyncio.run(calc())
+
+    def test_single_flight(self):
+        self.client.responses[self.routing_req] = '{"response":{"results":[{"length":1000,"crossTime":120}]}}'
+        flight = wrc.AsyncSingleFlight()
+
+        async def calc():
+            routes = [wrc.AsyncWazeRouteCalculator("47.1,19.1", "47.2,19.2", session=self.session, single_flight=flight) for _ in range(5)]
+            return await wrc.aio.asyncio.gather(*[route.calc_route_info() for route in routes])
+        assert wrc.aio.asyncio.run(calc()) == [(2.0, 1.0)] * 5
+        assert [url for url, params in self.client.requests] == [self.routing_req]
+        assert flight.stats() == {"calls": 1, "shared": 4, "in_flight": 0}
+
+    def test_route_cache_coalesces_misses(self):
+        self.client.responses[self.routing_req] = '{"response":{"results":[{"length":1000,"crossTime":120}]}}'
+        cache = wrc.RouteCache()
+
+        async def calc():
+            routes = [wrc.AsyncWazeRouteCalculator("47.1,19.1", "47.2,19.2", session=self.session, route_cache=cache) for _ in range(5)]
+            first = await wrc.aio.asyncio.gather(*[route.calc_route_info() for route in routes])
+            return first + [await routes[0].calc_route_info()]
+        assert wrc.aio.asyncio.run(calc()) == [(2.0, 1.0)] * 6
+        assert [url for url, params in self.client.requests] == [self.routing_req]
+
+    def test_get_routes(self):
+        async def calc():
+            route = wrc.AsyncWazeRouteCalculator("47.1,19.1", "47.2,19.2", session=self.session)
+            return await route.get_routes(npaths=2)
+        routes = wrc.aio.asyncio.run(calc())
+        assert [route.key for route in routes] == ["Best-test1", "Normal-test2"]
+
+    def test_calc_route_time_series(self):
+        self.client.responses[self.routing_req] = '{"response":{"results":[{"length":1000,"crossTime":120}]}}'
+
+        async def calc():
+            route = wrc.AsyncWazeRouteCalculator("47.1,19.1", "47.2,19.2", session=self.session)
+            return await route.calc_route_time_series([0, 30], max_workers=1)
+        series = wrc.aio.asyncio.run(calc())
+        assert series.series == [(0, 2.0, 1.0), (30, 2.0, 1.0)]
+        assert series.window == (0, 30)
+        assert sorted(params["at"] for url, params in self.client.requests) == ["0", "30"]
+
+    def test_calc_route_time_series_wrong_response(self):
+        self.client.responses[self.routing_req] = '{"response":{"foo":1}}'
+
+        async def calc():
+            route = wrc.AsyncWazeRouteCalculator("47.1,19.1", "47.2,19.2", session=self.session)
+            return await route.calc_route_time_series([0, 30])
+        with pytest.raises(wrc.WRCError) as err:
+            wrc.aio.asyncio.run(calc())
+        assert str(err.value) == "wrong response"
+
+    def test_scheduler_and_backend(self):
+        self.client.responses[self.routing_req] = '{"response":{"results":[{"length":1000,"crossTime":120}]}}'
+        scheduler = wrc.RequestScheduler(rate=100)
+
+        async def calc(backend):
+            route = wrc.AsyncWazeRouteCalculator("47.1,19.1", "47.2,19.2", session=self.session, scheduler=scheduler, backend=backend)
+            return await route.calc_route_info()
+        with wrc.ProcessBackend(max_workers=1) as backend:
+            assert wrc.aio.asyncio.run(calc(backend)) == (2.0, 1.0)
+        assert scheduler.stats()["priorities"][wrc.PRIORITY_INTERACTIVE]["count"] == 1
+
+
+class TestBenchmark():
+
+    def test_mock_server(self):
+        from benchmarks.mock_server import MockWazeServer
+        with MockWazeServer(segments=10, alternatives=2) as server:
+            route = server.calculator_class()("Mock start", "Mock end")
+            assert route.calc_route_info() == (sum(6 + i % 7 for i in range(10)) / 60.0, sum(80 + i % 40 for i in range(10)) / 1000.0)
+            assert len(route.calc_all_routes_info(npaths=2)) == 2
+        assert server.requests == 4
+
+    def test_run(self):
+        from benchmarks import run
+        results = run.run(segments=10, alternatives=2, iterations=3, concurrency=2)
+        assert sorted(results["results"]) == ["add_up_route", "add_up_route_columns", "add_up_route_numpy", "calc_all_routes_info", "calc_all_routes_info_processes", "calc_route_info", "geocode"]
+        assert results["results"]["geocode"]["iterations"] == 3
+        assert results["results"]["geocode"]["p50_ms"] <= results["results"]["geocode"]["max_ms"]